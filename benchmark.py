@@ -0,0 +1,279 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+An end-to-end benchmark of the pipeline on synthetic data (see synthetic_data.py).
+For every stage - ingestion, each of the result queries, the sqlite export, the dashboard
+table loading and the plot rendering - we measure the wall time, the throughput and how much
+the memory of the process (and of DuckDB's buffers) grew during the stage. Every run is appended to a results file, so runs can be
+compared to find regressions.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import duckdb_sqlite as pipeline
+import pipeline_metrics
+import search_index
+import snapshots
+import synthetic_data
+
+try:
+    import resource
+except ImportError:
+    # windows, the memory is then only sampled where /proc exists
+    resource = None
+
+# the directory of the benchmark data sets and of the results file
+BENCHMARK_DIR = "benchmarks"
+RESULTS_FILE = os.path.join(BENCHMARK_DIR, "results.jsonl")
+
+# a stage that got slower by more than this fraction is reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+# -------------- currentRss--------------
+def currentRss():
+    """
+    :return: the resident memory of the process in bytes (the peak so far where /proc is not available,
+             0 where neither is)
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0
+
+
+# -------------- duckdbMemory--------------
+def duckdbMemory(cursor):
+    """
+    :param cursor: a cursor of the DuckDB database
+    :return: the memory DuckDB's buffer manager holds right now in bytes (hash tables, sorts, cached blocks)
+    """
+    return cursor.execute("SELECT SUM(memory_usage_bytes) FROM duckdb_memory()").fetchone()[0] or 0
+
+
+# -------------- measure--------------
+def measure(results, stage, func, rows=None, database=None):
+    """
+    runs func while a background thread samples the resident memory every 10ms.
+    the memory of a stage is the peak over the memory at its start, the high-water mark of the process (and the
+    system_peak_buffer_memory of the DuckDB profile, which is the peak of the database instance) would carry
+    the earlier stages
+    :param results: the list the stage result is appended to
+    :param stage: the name of the stage
+    :param func: the work of the stage
+    :param rows: the number of rows the stage processes, for the throughput
+    :param database: the DuckDB connection the stage works on, its buffer memory is sampled as well
+    :return: what func returned
+    """
+    cursor = database.cursor() if database is not None else None
+    baseline = [currentRss(), duckdbMemory(cursor) if cursor else 0]
+    peak = list(baseline)
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.01):
+            peak[0] = max(peak[0], currentRss())
+            if cursor:
+                peak[1] = max(peak[1], duckdbMemory(cursor))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        value = func()
+    finally:
+        seconds = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    peak[0] = max(peak[0], currentRss())
+    if cursor:
+        peak[1] = max(peak[1], duckdbMemory(cursor))
+        cursor.close()
+
+    result = {
+        "stage": stage,
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_second": round(rows / seconds) if rows and seconds > 0 else None,
+        "rss_growth_mb": round((peak[0] - baseline[0]) / 2 ** 20, 1),
+        "duckdb_growth_mb": round((peak[1] - baseline[1]) / 2 ** 20, 1) if cursor else None,
+    }
+    results.append(result)
+    print(f"{stage:40} {seconds:9.3f}s  {result['rss_growth_mb']:+9.1f} MB"
+          + (f"  {result['duckdb_growth_mb']:+9.1f} MB duckdb" if cursor else "")
+          + (f"  {result['rows_per_second']:>12,} rows/s" if result['rows_per_second'] else ""))
+    return value
+
+
+# -------------- runPipelineStages--------------
+def runPipelineStages(results, rows):
+    """
+    a cold run of the etl: ingestion, the search index, every result query (without the result cache) and the export
+    """
+    for path in (pipeline.DUCKDB_FILE, pipeline.SQLITE_FILE, pipeline.STAGING_DIR, pipeline.ARROW_DIR,
+                 pipeline.SHARD_DIR, search_index.SEARCH_DIR, snapshots.SNAPSHOT_DIR):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    pipeline.openDatabase()
+    pipeline_metrics.createMetricsTable(pipeline.connection)
+    database = pipeline.connection
+    measure(results, "ingest", lambda: (pipeline.ingestCsv(pipeline.CSV_SOURCE), pipeline.refreshStaging()), rows,
+            database)
+    pipeline.createSampleTable()
+    measure(results, "search index", pipeline.createSearchIndex, rows, database)
+    for tableName, (query, _) in pipeline.QUERIES.items():
+        measure(results, f"query {tableName}", lambda: pipeline.saveTablesInDuckDB(tableName, query), rows, database)
+    workers = os.cpu_count() or 1
+    sources = [pipeline.shardSource(ranges) for ranges in pipeline.splitShards(pipeline.stagedFiles(), workers, True)]
+    measure(results, "map", lambda: pipeline.mapShards(sources, workers), rows, database)
+    measure(results, "reduce", pipeline.reduceShards, database=database)
+    measure(results, "arrow export", pipeline.duckdbToArrow, database=database)
+    measure(results, "sqlite export", pipeline.duckdbToSqlite, database=database)
+    measure(results, "publish snapshot", lambda: snapshots.publishSnapshot(
+        [pipeline.SQLITE_FILE, pipeline.ARROW_DIR, pipeline.STAGING_DIR, search_index.SEARCH_DIR],
+        pipeline.createExploreDatabase), database=database)
+    pipeline.connection.close()
+
+
+# -------------- runDashboardStages--------------
+def runDashboardStages(results):
+    """
+    importing the dashboard in a new process (the cold start), loading every dashboard table (from the Arrow
+    files and, to compare, from sqlite) and rendering every plot, with empty caches
+    """
+    # the benchmark runs in its work directory, the dashboard modules are next to this file
+    moduleDir = os.path.dirname(os.path.abspath(__file__))
+    measure(results, "dashboard import", lambda: subprocess.run(
+        [sys.executable, "-c", f"import sys; sys.path.insert(0, {moduleDir!r}); import dashboard_jobs_data"], check=True))
+    import dashboard_data as dd
+    import dashboard_plots as dp
+
+    for backend, suffix in (("sqlite", " [sqlite]"), ("arrow", "")):
+        dd.LOAD_BACKEND = backend
+        for tableName in dd.TABLES:
+            dd._read_table.clear()
+            measure(results, f"load {tableName}{suffix}", lambda: dd.load_table(tableName))
+
+    # the figures with the default filters of every page
+    for plotName, (key, render) in dp.default_renders().items():
+        dp._render_cache.clear()
+        measure(results, f"render {plotName}", lambda: dp.cached_render(key, render))
+
+    for keywords in ("python selenium", "health insurance remote"):
+        dd._search.clear()
+        measure(results, f"search {keywords}", lambda: dd.search_jobs(keywords))
+
+
+# -------------- gitCommit--------------
+def gitCommit():
+    """
+    :return: the current git commit, so results can be matched to the code they measured
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# -------------- runBenchmark--------------
+def runBenchmark(scale, rows, seed=42, shards=1, resultsFile=RESULTS_FILE):
+    """
+    generates (once) the data set of a scale in its own directory, runs all the stages on it
+    and appends the run to the results file
+    :return: the run record
+    """
+    resultsFile = os.path.abspath(resultsFile)
+    workDir = os.path.join(BENCHMARK_DIR, scale)
+    os.makedirs(workDir, exist_ok=True)
+    commit = gitCommit()
+    startDir = os.getcwd()
+    os.chdir(workDir)
+    try:
+        output = "job_descriptions.csv"
+        pipeline.CSV_SOURCE = output if shards == 1 else "job_descriptions-*.csv"
+        if not any(os.path.exists(file) for file in [output, "job_descriptions-00000.csv"]):
+            print(f"generating {rows:,} rows")
+            synthetic_data.generateJobsCsv(output, rows, seed, shards=shards)
+
+        stages = []
+        runPipelineStages(stages, rows)
+        runDashboardStages(stages)
+    finally:
+        os.chdir(startDir)
+
+    run = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "scale": scale,
+        "rows": rows,
+        "seed": seed,
+        "shards": shards,
+        "stages": stages,
+    }
+    os.makedirs(os.path.dirname(resultsFile), exist_ok=True)
+    with open(resultsFile, "a") as results:
+        results.write(json.dumps(run) + "\n")
+    return run
+
+
+# -------------- compareRuns--------------
+def compareRuns(scale, resultsFile=RESULTS_FILE, threshold=REGRESSION_THRESHOLD):
+    """
+    prints the last run of a scale next to the run before it
+    :return: the stages that got slower by more than threshold
+    """
+    with open(resultsFile) as results:
+        runs = [run for run in map(json.loads, results) if run["scale"] == scale]
+    if len(runs) < 2:
+        print(f"{scale}: need two runs to compare")
+        return []
+    previous, current = runs[-2], runs[-1]
+    previousSeconds = dict((stage["stage"], stage["seconds"]) for stage in previous["stages"])
+    print(f"{scale}: {previous['commit']} ({previous['timestamp']}) -> {current['commit']} ({current['timestamp']})")
+    regressions = []
+    for stage in current["stages"]:
+        before = previousSeconds.get(stage["stage"])
+        if not before:
+            continue
+        change = (stage["seconds"] - before) / before
+        flag = ""
+        if change > threshold:
+            regressions.append(stage["stage"])
+            flag = "  REGRESSION"
+        print(f"{stage['stage']:40} {before:9.3f}s -> {stage['seconds']:9.3f}s  {change:+7.1%}{flag}")
+    return regressions
+
+
+# -------------- main--------------
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the pipeline on synthetic data")
+    parser.add_argument("--scale", nargs="+", default=["100k"], choices=list(synthetic_data.SCALES))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--shards", type=int, default=1, help="split the synthetic data into this many csv files")
+    parser.add_argument("--compare", action="store_true", help="compare every run with the previous run of its scale")
+    args = parser.parse_args()
+
+    for scale in args.scale:
+        print(f"---------------- {scale} ----------------")
+        runBenchmark(scale, synthetic_data.SCALES[scale], args.seed, args.shards)
+        if args.compare:
+            compareRuns(scale)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman - 211694146
+# Alon Zargari - 208626515
+
+"""
+This file is the data access layer of the dashboard.
+A table is read only when a page needs it, and is kept in a process wide cache that all the
+Streamlit sessions share. Tables are memory mapped from the Arrow files of the exporter, with
+categorical and Arrow string columns instead of python string objects, or read from SQLite.
+Everything is read from the current snapshot the pipeline published (snapshots.py) and the caches are keyed
+on it, so a new run is picked up at the next request and a running pipeline never blocks the dashboard.
+The read-only SQLite connections and the DuckDB database of a snapshot are shared by all the sessions.
+Filter widgets are turned into parameterized queries against the indexed tables, so only
+the filtered and aggregated rows reach the plotting code. Any combination of filters on the
+cube dimensions is answered from one grouping set of the JobsCube table.
+Ad-hoc SQL of the Explore page runs on a cursor of the read-only DuckDB database, and its results
+are streamed page by page as Arrow record batches.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import queue
+import sqlite3
+import threading
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import streamlit as st
+import jobs_cube
+import search_index
+import snapshots
+
+SQLITE_FILE = "db_file.sqlite"
+# the DuckDB database of the Explore and Search pages, its views read only the parquet parts of the snapshot
+EXPLORE_FILE = "explore.duckdb"
+ARROW_DIR = "arrow_tables"
+
+# the idle read-only SQLite connections kept for the current snapshot
+SQLITE_POOL_SIZE = 8
+
+# "arrow" reads the tables from the Arrow files when they were exported, "sqlite" always reads them with pd.read_sql
+LOAD_BACKEND = "arrow"
+
+# limits of the ad-hoc queries of the Explore page
+EXPLORE_TIMEOUT_SECONDS = 10
+EXPLORE_MAX_ROWS = 100_000
+EXPLORE_PAGE_ROWS = 500
+EXPLORE_MEMORY_LIMIT = "1GB"
+
+SEARCH_PAGE_ROWS = 20
+# the JobsData columns of a search result
+SEARCH_COLUMNS = ("Job Id", "Job Title", "Role", "Company", "Country", "Job Portal", "Job Posting Date", "skills")
+
+# the time to first render of every session is appended here, one json line per session
+RENDER_TIMES_FILE = "render_times.jsonl"
+
+# the tables the dashboard pages read
+TABLES = ("SampleJobsData", "SampleByPortal", "TopCountriesJobPosts", "MinimumExperience", "Discrimination",
+          "JobMarketRatings", "UnderMinimum", "PipelineMetrics")
+
+# the dimensions of JobsCube, in the order of the bits of its Grouping_Id
+CUBE_DIMENSIONS = jobs_cube.CUBE_DIMENSIONS
+
+# this module is imported once per server process, the first session it serves pays for the imports
+_render_times_lock = threading.Lock()
+_process_rendered = False
+
+
+def _current_snapshot():
+
+    """Returns the directory of the snapshot the pipeline published last."""
+
+    snapshot = snapshots.currentSnapshot()
+    if snapshot is None:
+        raise FileNotFoundError("no snapshot was published yet, run duckdb_sqlite.py first")
+    return snapshot
+
+
+def pin_data_version():
+
+    """
+    Resolves the current snapshot once, at the start of a script run, and keeps it in the session state.
+    Every read of the run uses it, so a run never mixes two snapshots when the pipeline publishes one meanwhile,
+    and the next run picks the new snapshot up.
+    """
+
+    st.session_state['data_version'] = _current_snapshot()
+    return st.session_state['data_version']
+
+
+def data_version():
+
+    """
+    Returns the directory of the snapshot pinned for this script run (the current snapshot when none was pinned),
+    it is also the version of the data in all the caches.
+    """
+
+    version = st.session_state.get('data_version')
+    return version if version is not None else _current_snapshot()
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _sqlite_pool(version):
+
+    """Returns the pool of idle connections to the SQLite file of a snapshot, shared by all the sessions."""
+
+    return queue.LifoQueue(maxsize=SQLITE_POOL_SIZE)
+
+
+@contextlib.contextmanager
+def _sqlite_connection(version):
+
+    """
+    Lends a read-only connection to the SQLite file of a snapshot, a new one is opened when all the pooled
+    connections are in use. The snapshot never changes, so SQLite opens it as immutable, without any locking.
+    """
+
+    pool = _sqlite_pool(version)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        path = os.path.join(version, SQLITE_FILE).replace(os.sep, "/")
+        conn = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+    try:
+        yield conn
+    finally:
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _duckdb_database(version):
+
+    """
+    Opens the DuckDB database of a snapshot read-only, once per process. Every request uses its own cursor.
+    The Explore queries run on it, so it can only open the files of the snapshot and no other file of the
+    server, and the configuration is locked so a query cannot lift the limits.
+    """
+
+    conn = duckdb.connect(os.path.join(version, EXPLORE_FILE), read_only=True,
+                          config={"memory_limit": EXPLORE_MEMORY_LIMIT})
+    conn.execute("SET allowed_directories = ?", [[version + os.sep]])
+    conn.execute("SET enable_external_access = false")
+    conn.execute("SET lock_configuration = true")
+    return conn
+
+
+@st.cache_resource(max_entries=2 * len(TABLES), show_spinner=False)
+def _read_table(table_name, version):
+
+    """
+    Reads a whole table, cached per (table, version).
+    The frame is shared by all the sessions, so callers must not modify it in place.
+    """
+
+    arrow_file = os.path.join(version, ARROW_DIR, f"{table_name}.arrow")
+    if LOAD_BACKEND == "arrow" and os.path.exists(arrow_file):
+        return _read_arrow(arrow_file)
+    with _sqlite_connection(version) as conn:
+        return pd.read_sql(f"SELECT * FROM {table_name}", conn)
+
+
+def _read_arrow(arrow_file):
+
+    """
+    Memory maps an Arrow IPC file and returns it as a dataframe without copying it.
+    Dictionary columns become categoricals and string columns stay Arrow strings.
+    """
+
+    table = pa.ipc.open_file(pa.memory_map(arrow_file)).read_all()
+    return table.to_pandas(types_mapper=lambda arrow_type: pd.ArrowDtype(arrow_type)
+                           if pa.types.is_string(arrow_type) else None)
+
+
+def load_table(table_name):
+
+    """Returns the dataframe of a dashboard table from the shared cache."""
+
+    if table_name not in TABLES:
+        raise ValueError(f"unknown table: {table_name}")
+    return _read_table(table_name, data_version())
+
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def _run_query(sql, params, version):
+
+    """Runs a parameterized read-only query, cached per (sql, params, version)."""
+
+    with _sqlite_connection(version) as conn:
+        return pd.read_sql(sql, conn, params=params)
+
+
+def query(sql, params=()):
+
+    """Runs a parameterized query against the SQLite database and returns a dataframe."""
+
+    return _run_query(sql, tuple(params), data_version())
+
+
+def in_clause(column, values):
+
+    """Returns a "column IN (?, ?, ...)" condition and its parameters for a widget selection."""
+
+    return f"{column} IN ({', '.join('?' * len(values))})", list(values)
+
+
+def distinct_values(table_name, column):
+
+    """Returns the sorted distinct values of a column, used as the options of a filter widget."""
+
+    if table_name not in TABLES:
+        raise ValueError(f"unknown table: {table_name}")
+    return query(f"SELECT DISTINCT {column} FROM {table_name} ORDER BY {column}")[column].tolist()
+
+
+def cube_values(dimension):
+
+    """Returns the sorted values of a cube dimension, read from its single dimension grouping set."""
+
+    if dimension not in CUBE_DIMENSIONS:
+        raise ValueError(f"unknown cube dimension: {dimension}")
+    return query(f"""
+        SELECT {dimension} FROM JobsCube
+        WHERE Grouping_Id = ? AND {dimension} IS NOT NULL
+        ORDER BY {dimension}
+    """, [jobs_cube.cubeGroupingId([dimension])])[dimension].tolist()
+
+
+def cube_slice(group_by, filters=None):
+
+    """
+    Returns the job count and the average minimum and maximum salary per combination of the group_by dimensions.
+    filters maps a dimension to a value or to a list of selected values. The rows are read from the smallest kept
+    grouping set with the group_by and the filtered dimensions and summed, so no slice needs more than one indexed
+    range of the cube.
+    """
+
+    filters = filters or {}
+    unknown = [dimension for dimension in list(group_by) + list(filters) if dimension not in CUBE_DIMENSIONS]
+    if unknown:
+        raise ValueError(f"unknown cube dimensions: {', '.join(unknown)}")
+    measures = ['Job_Count', 'Avg_Min_Salary', 'Avg_Max_Salary']
+    conditions = ["Grouping_Id = ?"]
+    params = [jobs_cube.cubeGroupingId(jobs_cube.cubeGroupingSet(set(group_by) | set(filters)))]
+    for dimension, values in filters.items():
+        if isinstance(values, (list, tuple)):
+            if not values:
+                return pd.DataFrame(columns=list(group_by) + measures)
+            condition, values_params = in_clause(dimension, values)
+        else:
+            condition, values_params = f"{dimension} = ?", [values]
+        conditions.append(condition)
+        params += values_params
+    columns = ", ".join(group_by)
+    return query(f"""
+        SELECT {columns + ", " if group_by else ""}SUM(Job_Count) AS Job_Count,
+               CAST(SUM(Min_Salary_Sum) AS REAL) / SUM(Salary_Count) AS Avg_Min_Salary,
+               CAST(SUM(Max_Salary_Sum) AS REAL) / SUM(Salary_Count) AS Avg_Max_Salary
+        FROM JobsCube
+        WHERE {" AND ".join(conditions)}
+        {f"GROUP BY {columns} ORDER BY {columns}" if group_by else ""}
+    """, params)
+
+
+def min_experience_counts(experience, years, qualifications):
+
+    """Returns the job count per qualification and year for one experience level and the selected years and degrees."""
+
+    counts = cube_slice(['Qualifications', 'Year'],
+                        {'Min_Experience': int(experience), 'Year': years, 'Qualifications': qualifications})
+    return counts[['Qualifications', 'Year', 'Job_Count']].rename(columns={'Job_Count': 'Job_count'})
+
+
+def discrimination_rows(country, preference, qualifications):
+
+    """Returns the job count per selected qualification of one country and preference."""
+
+    rows = cube_slice(['Qualifications', 'Preference', 'Country'],
+                      {'Country': country, 'Preference': preference, 'Qualifications': qualifications})
+    return rows[['Qualifications', 'Preference', 'Country', 'Job_Count']].astype({'Job_Count': float})
+
+
+def discrimination_average(country, preference, qualifications):
+
+    """Returns the average job count over the selected qualifications of one country and preference."""
+
+    rows = discrimination_rows(country, preference, qualifications)
+    return rows.groupby('Country', as_index=False)['Job_Count'].mean()
+
+
+def explore_statement(sql):
+
+    """Returns the sql of a single SELECT statement, raises ValueError for anything else."""
+
+    statements = duckdb.extract_statements(sql)
+    if len(statements) != 1:
+        raise ValueError("enter exactly one statement")
+    if statements[0].type != duckdb.StatementType.SELECT:
+        raise ValueError("only SELECT statements can be explored")
+    return statements[0].query.strip()
+
+
+def _explore_connection():
+
+    """
+    Returns a cursor on the shared DuckDB database of the current snapshot for one request.
+    Closing it only closes the cursor, the pipeline writes its own working database.
+    """
+
+    return _duckdb_database(data_version()).cursor()
+
+
+def _quote(column):
+
+    """Returns a quoted column name."""
+
+    return '"' + column.replace('"', '""') + '"'
+
+
+def explore_columns(sql):
+
+    """Returns the (column, type) pairs of the result of an explore query without running it, raises ValueError."""
+
+    statement = explore_statement(sql)
+    try:
+        conn = _explore_connection()
+        try:
+            return [(column, column_type) for column, column_type, *_ in
+                    conn.execute(f"DESCRIBE {statement}").fetchall()]
+        finally:
+            conn.close()
+    except duckdb.Error as error:
+        raise ValueError(str(error)) from error
+
+
+def explore_page(sql, keys, after=None, offset=0, page_rows=EXPLORE_PAGE_ROWS, timeout=EXPLORE_TIMEOUT_SECONDS):
+
+    """
+    Returns an Arrow table with the next page_rows rows of an explore query, in the order of the key columns.
+    The pages are keyset paginated: after holds the key values of the last row of the previous page, so
+    every page is a new bounded query and no more than one page is ever held in memory. The rows are read
+    as Arrow record batches and the query is interrupted after timeout seconds (TimeoutError).
+    offset is the number of rows of the previous pages, a page never reaches past EXPLORE_MAX_ROWS
+    (ValueError when it would start there).
+    The keys should be unique, rows with the same keys as the last row of a page are skipped.
+    """
+
+    statement = explore_statement(sql)
+    limit = min(int(page_rows), EXPLORE_MAX_ROWS - int(offset))
+    if limit <= 0:
+        raise ValueError(f"at most {EXPLORE_MAX_ROWS:,} rows can be paged through")
+    key_columns = ", ".join(_quote(key) for key in keys)
+    condition = ""
+    params = []
+    if after is not None:
+        condition = f"WHERE ({key_columns}) > ({', '.join('?' * len(keys))})"
+        params = list(after)
+    page_sql = f"""
+        SELECT * FROM ({statement}) AS explored
+        {condition}
+        ORDER BY {key_columns}
+        LIMIT {limit}
+    """
+
+    conn = _explore_connection()
+    timer = threading.Timer(timeout, conn.interrupt)
+    timer.start()
+    try:
+        reader = conn.execute(page_sql, params).to_arrow_reader(min(limit, 10_000))
+        batches = list(reader)
+        return pa.Table.from_batches(batches, schema=reader.schema)
+    except duckdb.InterruptException:
+        raise TimeoutError(f"the query was stopped after {timeout} seconds")
+    except duckdb.Error as error:
+        raise ValueError(str(error)) from error
+    finally:
+        timer.cancel()
+        conn.close()
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _search(terms, page, page_rows, version):
+
+    """Runs a ranked search on the DuckDB full text index, cached per (terms, page, version)."""
+
+    sql, params = search_index.searchQuery(terms, SEARCH_COLUMNS, page_rows, page * page_rows)
+    try:
+        conn = _explore_connection()
+        try:
+            return conn.execute(sql, params).df()
+        finally:
+            conn.close()
+    except duckdb.Error as error:
+        # also when the index was not built yet
+        raise ValueError(str(error)) from error
+
+
+def search_jobs(text, page=0, page_rows=SEARCH_PAGE_ROWS):
+
+    """
+    Returns a page of the job postings that match the words of text, best BM25 score first, and the number
+    of matching postings. Raises ValueError when the index cannot be read.
+    """
+
+    terms = tuple(search_index.searchTerms(text))
+    if not terms:
+        return pd.DataFrame(columns=list(SEARCH_COLUMNS) + ['Score']), 0
+    results = _search(terms, page, page_rows, data_version())
+    matches = int(results['Matches'].iloc[0]) if len(results) else 0
+    return results.drop(columns='Matches'), matches
+
+
+def record_first_render(page, seconds):
+
+    """
+    Appends the time to first render of a session to RENDER_TIMES_FILE, with the page it opened and whether
+    it was the first session of the server process (a cold start, which includes the imports).
+    The later reruns of the session are not recorded.
+    """
+
+    global _process_rendered
+    if st.session_state.get('first_render_recorded'):
+        return
+    st.session_state['first_render_recorded'] = True
+    with _render_times_lock:
+        cold_start = not _process_rendered
+        _process_rendered = True
+        record = {"Time": datetime.datetime.now().isoformat(timespec="seconds"), "Page": page,
+                  "Seconds": round(seconds, 4), "Cold_Start": cold_start}
+        with open(RENDER_TIMES_FILE, "a") as file:
+            file.write(json.dumps(record) + "\n")
@@ -6,11 +6,17 @@
 """
 This file is an interactive Streamlit dashboard designed for visual analysis
 of the job market data. It loads data from an SQLite database and presents
-insights on job postings
+insights on job postings.
+The plotting libraries are imported by the first page that draws, and the time to first render of
+every session is recorded in render_times.jsonl.
 """
 
-import sqlite3
-import pandas as pd
+import time
+
+# streamlit executes this script on every rerun, the time is taken before the imports of the first run
+RUN_STARTED = time.perf_counter()
+
+import dashboard_data as dd
 import dashboard_plots as dp
 import streamlit as st
 
@@ -29,21 +35,6 @@ def configure_page():
     """, unsafe_allow_html=True)
 
 
-def load_data():
-
-    """Loads job market data from an SQLite database into Pandas dataframes."""
-
-    conn = sqlite3.connect('db_file.sqlite')
-    sample_jobs_data = pd.read_sql("SELECT * FROM SampleJobsData", conn)
-    top_countries_job_posts = pd.read_sql("SELECT * FROM TopCountriesJobPosts", conn)
-    min_exp = pd.read_sql("SELECT * FROM MinimumExperience", conn)
-    discrimination = pd.read_sql("SELECT * FROM Discrimination", conn)
-    job_market_ratings = pd.read_sql("SELECT * FROM JobMarketRatings", conn)
-    under_minimum = pd.read_sql("SELECT * FROM UnderMinimum", conn)
-    conn.close()
-    return sample_jobs_data, top_countries_job_posts, min_exp, discrimination, job_market_ratings, under_minimum
-
-
 def display_page_layout(title, question, content_text, plot_func, df):
 
     """Creates a structured page layout with a title, insights, table, and visualization."""
@@ -58,7 +49,7 @@ def display_page_layout(title, question, content_text, plot_func, df):
         st.dataframe(df)
     st.divider()
     st.subheader("Visualization")
-    plot_func(df)
+    plot_func()
 
 
 def story_page():
@@ -93,7 +84,7 @@ def under_min_salary_page(df):
                 This information is important because it helps us identify where pay gaps exist, which can affect how happy and committed employees are.
                 The size of each word could depends the amount of jobs that its posts with under minimum salary offer 
                 """
-    display_page_layout(title, question, into_text, dp.under_min_salary_plot, df)
+    display_page_layout(title, question, into_text, lambda: dp.under_min_salary_plot(df), df)
 
 
 def Recruiters_portals_page(df):
@@ -107,7 +98,7 @@ def Recruiters_portals_page(df):
                 It also lists the top three recruiters for each website, pointing out the key people in the job market. This information is important
                 for job seekers and employers because it helps them focus on the websites and people that can best help them reach their work goals.
                 """
-    display_page_layout(title, question, into_text, dp.recruiters_portal_ranking_plots, df)
+    display_page_layout(title, question, into_text, lambda: dp.recruiters_portal_ranking_plots(df), df)
 
 
 def discrimination_posts_page(df):
@@ -154,12 +145,149 @@ def top_country_jobs_page(df):
          The leading companies highlight trends in various industries.
         """
 
-    display_page_layout(title, question, into_text, dp.leading_countries_job_posts, df)
+    display_page_layout(title, question, into_text, lambda: dp.leading_countries_job_posts(df), df)
+
+
+def job_market_cube_page():
+
+    """Lets the user slice the job market cube by any combination of its dimensions."""
+
+    title = "Job market cube"
+    question = "How many jobs, and at what salaries, are there for any combination of country, qualification, preference, year, experience and portal?"
+    into_text = """
+         The pipeline counts the job posts and sums their salaries once for every combination of these six dimensions.
+         Pick the dimensions to group by and filter the others, every slice is read from the precomputed cube
+         instead of scanning all the job posts again. The table shows the jobs and the average salaries per year.
+        """
+
+    display_page_layout(title, question, into_text, dp.job_market_cube_plot, dd.cube_slice(['Year']))
+
+
+def explore_page():
+
+    """Runs ad-hoc read-only SQL on the DuckDB database and pages through the result."""
+
+    text = """
+         Ask a question that none of the pages answers: the query runs on the DuckDB database of the
+         published data (JobsData, JobsStaged, JobsCube and all the result tables) on a read-only connection.
+         The result is shown one page at a time, ordered by the columns you page by, so even a query
+         that returns millions of rows only reads one page into the dashboard.
+        """
+    st.title("Explore")
+    st.divider()
+    st.subheader("Ask your own question with SQL")
+    st.markdown(f"<div class='big-font'>{text}</div>", unsafe_allow_html=True)
+    st.caption(f"a query is stopped after {dd.EXPLORE_TIMEOUT_SECONDS} seconds and at most "
+               f"{dd.EXPLORE_MAX_ROWS:,} rows can be paged through")
+
+    col1, _, col2 = st.columns([3, 0.2, 1])
+    with col1:
+        sql = st.text_area("SQL:", value="SELECT * FROM JobsCube WHERE Grouping_Id = 31", height=150)
+    try:
+        columns = [column for column, _ in dd.explore_columns(sql)]
+    except ValueError as error:
+        st.error(str(error))
+        return
+    with col2:
+        keys = st.multiselect("Page By (unique) Columns:", columns, default=columns[:1])
+        page_rows = st.selectbox("Rows per Page:", [50, 100, dd.EXPLORE_PAGE_ROWS], index=1)
+    if not keys:
+        st.warning("select the columns to page by")
+        return
+
+    # the key values of the last row of every previous page, reset when the query changes
+    query_id = (sql, tuple(keys), page_rows)
+    if st.session_state.get('explore_query') != query_id:
+        st.session_state['explore_query'] = query_id
+        st.session_state['explore_starts'] = [None]
+    starts = st.session_state['explore_starts']
+
+    first_row = (len(starts) - 1) * page_rows
+    try:
+        page = dd.explore_page(sql, keys, starts[-1], first_row, page_rows)
+    except (ValueError, TimeoutError) as error:
+        st.error(str(error))
+        return
+    st.dataframe(page.to_pandas())
+    st.caption(f"page {len(starts)}: rows {first_row + 1 if page.num_rows else 0:,} - {first_row + page.num_rows:,}")
+
+    col_previous, col_next, _ = st.columns([1, 1, 6])
+    with col_previous:
+        if st.button("Previous", disabled=len(starts) == 1):
+            starts.pop()
+            st.rerun()
+    with col_next:
+        last_page = page.num_rows < page_rows or first_row + page.num_rows >= dd.EXPLORE_MAX_ROWS
+        if st.button("Next", disabled=last_page):
+            starts.append(tuple(page.column(key)[page.num_rows - 1].as_py() for key in keys))
+            st.rerun()
+
+
+def search_page():
+
+    """Searches the job postings by keywords and pages through the ranked results."""
+
+    text = """
+         Search all the job postings by a skill, a job title or a benefit. The words are looked up in a
+         full text index of the titles, descriptions, skills, benefits and responsibilities, and the
+         postings are ranked by their BM25 score: rare words and postings that mention them often rank first.
+        """
+    st.title("Search")
+    st.divider()
+    st.subheader("Find job postings by keywords")
+    st.markdown(f"<div class='big-font'>{text}</div>", unsafe_allow_html=True)
+
+    search_text = st.text_input("Keywords:", value="python selenium")
+
+    # the page number, reset when the search changes
+    if st.session_state.get('search_text') != search_text:
+        st.session_state['search_text'] = search_text
+        st.session_state['search_page'] = 0
+    page = st.session_state['search_page']
+
+    try:
+        results, matches = dd.search_jobs(search_text, page)
+    except ValueError as error:
+        st.error(f"the search index could not be read: {error}")
+        return
+    if not matches:
+        st.info("no job posting matches these keywords")
+        return
+    first_row = page * dd.SEARCH_PAGE_ROWS
+    st.caption(f"{matches:,} matching postings, showing {first_row + 1:,} - {first_row + len(results):,}")
+    st.dataframe(results, hide_index=True)
+
+    col_previous, col_next, _ = st.columns([1, 1, 6])
+    with col_previous:
+        if st.button("Previous", disabled=page == 0):
+            st.session_state['search_page'] -= 1
+            st.rerun()
+    with col_next:
+        if st.button("Next", disabled=first_row + len(results) >= matches):
+            st.session_state['search_page'] += 1
+            st.rerun()
+
+
+def pipeline_performance_page(df):
+
+    """Shows the wall time, rows and memory of every pipeline step across the runs."""
+
+    title = "Pipeline performance"
+    question = "Which step of the nightly pipeline got slower, and since which run?"
+    into_text = """
+         Every run of duckdb_sqlite.py records the wall time, the rows in and out and the peak memory of each step
+         (ingestion, staging, every query and the sqlite export) together with the DuckDB profile of the queries.
+         The chart follows a metric of the selected steps across the runs, so a regression shows up on the day it lands.
+         The metrics of the export step of a run appear after the next run.
+        """
+
+    history = df.drop(columns=['Profile']).sort_values('Run_Started', ascending=False)
+    display_page_layout(title, question, into_text, lambda: dp.pipeline_performance_plot(df), history)
 
 
-def home_page(df):
+def home_page():
 
-    """Provides an overview of the dataset and displays sample job data."""
+    """Provides an overview of the dataset and displays a sample of the jobs, stratified by the selected column."""
 
     text = """
         This dataset includes a collection of simulated job advertisements created for research purposes.
@@ -172,24 +300,33 @@ def home_page(df):
     st.markdown(f"<div class='big-font'>{text}</div>", unsafe_allow_html=True)
     st.caption(
         "the dataset is `job_descriptions.csv`. link to the website [Job Dataset](https://www.kaggle.com/datasets/ravindrasinghrana/job-description-dataset)")
-    st.dataframe(df)
+    # every country (or portal) appears in its sample with the same number of jobs
+    samples = {"Country": "SampleJobsData", "Job Portal": "SampleByPortal"}
+    stratify = st.radio("Sample stratified by:", list(samples), horizontal=True)
+    st.dataframe(dd.load_table(samples[stratify]))
     st.caption("submitting: Re'em Hoisman- 211694146 and Alon Zargari - 208626515")
 
 
 def main():
-    """Initializes the dashboard, loads data, and manages page navigation."""
+    """Initializes the dashboard and manages page navigation, loading only the selected page's data."""
 
     configure_page()
-    sample_jobs_data, top_country_jobs, min_exp, discrimination, job_market_ratings, under_minimum = load_data()
+    # all the reads of this run use the same snapshot
+    dd.pin_data_version()
     st.sidebar.title("Pages Menu")
 
+    # every page loads only its own table, when it is selected
     page_functions = {
-        "Home": (home_page, sample_jobs_data),
-        "Top Companies in Leading Countries": (top_country_jobs_page, top_country_jobs),
-        "Minimum experience distribution": (min_experience_page, min_exp),
-        "Discrimination posts": (discrimination_posts_page, discrimination),
-        "Recruiters and portal ranking": (Recruiters_portals_page, job_market_ratings),
-        "UnderMinimum": (under_min_salary_page, under_minimum),
+        "Home": (home_page, None),
+        "Top Companies in Leading Countries": (top_country_jobs_page, "TopCountriesJobPosts"),
+        "Minimum experience distribution": (min_experience_page, "MinimumExperience"),
+        "Discrimination posts": (discrimination_posts_page, "Discrimination"),
+        "Recruiters and portal ranking": (Recruiters_portals_page, "JobMarketRatings"),
+        "UnderMinimum": (under_min_salary_page, "UnderMinimum"),
+        "Job market cube": (job_market_cube_page, None),
+        "Pipeline performance": (pipeline_performance_page, "PipelineMetrics"),
+        "Explore": (explore_page, None),
+        "Search": (search_page, None),
         "Story": story_page
     }
 
@@ -198,8 +335,14 @@ def main():
     if selection == "Story":
         story_page()
     else:
-        page_function, data_to_use = page_functions[selection]
-        page_function(data_to_use)
+        page_function, table_name = page_functions[selection]
+        if table_name is None:
+            # the page queries its own slices
+            page_function()
+        else:
+            page_function(dd.load_table(table_name))
+
+    dd.record_first_render(selection, time.perf_counter() - RUN_STARTED)
 
 
 if __name__ == "__main__":
@@ -7,13 +7,144 @@
 This file aggregates multiple plotting functions designed to visualize job market data.
 It provides various charts and visual representations to help users analyze query results
 interactively within a Streamlit dashboard.
+Rendered figures are kept in a bounded LRU cache (PNG bytes or Plotly json) keyed on the plot,
+its input data and the filters, and matplotlib figures are closed as soon as they are saved.
+The figures of the default filters are read from the figure cache directory of the current snapshot,
+prewarm.py renders them there after every pipeline run, so a new server process shows them without
+rendering. The dashboard itself never writes into a published snapshot, the other figures stay in memory.
+Matplotlib, Plotly and WordCloud take about a second to import, they are imported by the
+functions that draw with them, so the pages that do not draw are not slowed down by them.
 """
 
-import matplotlib.pyplot as plt
-import plotly.express as px
-import streamlit as st
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
 import pandas as pd
-from wordcloud import WordCloud
+import streamlit as st
+import dashboard_data as dd
+
+# bounds of the rendered figures cache, shared by all the sessions of the server process
+RENDER_CACHE_MAX_ENTRIES = 64
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# the directory of the rendered figures in every snapshot, a file per render key named <key hash>.<png or json>
+FIGURE_CACHE_DIR = "figures"
+
+# render key -> ("png", bytes) or ("plotly", figure json), least recently used first
+_render_cache = OrderedDict()
+_render_cache_bytes = 0
+_render_cache_lock = threading.Lock()
+
+
+def data_hash(df):
+
+    """Returns a hash of the columns and the values of a dataframe."""
+
+    digest = hashlib.sha256(repr(list(df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def render_key(plot_name, df, **params):
+
+    """Returns the cache key of a figure: the plot, a hash of its input data and the filter parameters."""
+
+    return plot_name, data_hash(df), repr(sorted(params.items()))
+
+
+def _figure_file(key, kind):
+
+    """Returns the path of the figure of a render key in the figure cache directory of the current snapshot."""
+
+    name = hashlib.sha256(repr(key).encode()).hexdigest()
+    return os.path.join(dd.data_version(), FIGURE_CACHE_DIR, f"{name}.{'png' if kind == 'png' else 'json'}")
+
+
+def _read_figure(key):
+
+    """Returns the rendered figure of key from the figure cache directory, None when it was not saved."""
+
+    for kind in ('png', 'plotly'):
+        try:
+            with open(_figure_file(key, kind), 'rb') as file:
+                content = file.read()
+        except OSError:
+            continue
+        return kind, content if kind == 'png' else content.decode()
+    return None
+
+
+def _save_figure(key, rendered):
+
+    """Saves a rendered figure in the figure cache directory, with a rename so readers never see half a file."""
+
+    kind, content = rendered
+    figure_file = _figure_file(key, kind)
+    try:
+        os.makedirs(os.path.dirname(figure_file), exist_ok=True)
+        temp_file = f"{figure_file}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as file:
+            file.write(content if kind == 'png' else content.encode())
+        os.replace(temp_file, figure_file)
+    except OSError:
+        # the snapshot was removed meanwhile, the figure is only kept in memory
+        pass
+
+
+def cached_render(key, render, persist=False):
+
+    """
+    Returns the rendered figure of key from the cache, from the figure cache directory, or calls render()
+    to build it. Matplotlib figures are saved as PNG bytes and closed right away, Plotly figures are kept as json.
+    A figure that was rendered is saved in the figure cache directory only when persist is set (by prewarm.py,
+    for the default renders), so the directory holds a fixed number of figures per snapshot.
+    """
+
+    global _render_cache_bytes
+    with _render_cache_lock:
+        if key in _render_cache:
+            _render_cache.move_to_end(key)
+            return _render_cache[key]
+
+    rendered = _read_figure(key)
+    if rendered is None:
+        fig = render()
+        if hasattr(fig, 'to_json'):
+            rendered = ('plotly', fig.to_json())
+        else:
+            import matplotlib.pyplot as plt
+            try:
+                buffer = io.BytesIO()
+                fig.savefig(buffer, format='png', bbox_inches='tight')
+                rendered = ('png', buffer.getvalue())
+            finally:
+                plt.close(fig)
+        if persist:
+            _save_figure(key, rendered)
+
+    with _render_cache_lock:
+        if key not in _render_cache:
+            _render_cache[key] = rendered
+            _render_cache_bytes += len(rendered[1])
+        while _render_cache and (len(_render_cache) > RENDER_CACHE_MAX_ENTRIES or
+                                 _render_cache_bytes > RENDER_CACHE_MAX_BYTES):
+            _, evicted = _render_cache.popitem(last=False)
+            _render_cache_bytes -= len(evicted[1])
+    return rendered
+
+
+def show_figure(rendered):
+
+    """Displays a figure returned by cached_render."""
+
+    kind, content = rendered
+    if kind == 'png':
+        st.image(content)
+    else:
+        import plotly.io as pio
+        st.plotly_chart(pio.from_json(content))
 
 
 def recruiters_portal_ranking_plots(df):
@@ -23,6 +154,18 @@ def recruiters_portal_ranking_plots(df):
     highlighting the top 3 recruiters for each.
     """
 
+    rendered = cached_render(render_key('recruiters_portal_ranking', df),
+                             lambda: recruiters_portal_ranking_figure(df))
+    _, col1, _ = st.columns([0.5, 2, 0.5])
+    with col1:
+        show_figure(rendered)
+
+
+def recruiters_portal_ranking_figure(df):
+
+    """Builds the stem plot figure of recruiters_portal_ranking_plots."""
+
+    import matplotlib.pyplot as plt
     portal_jobs = df.drop_duplicates('Portal')[['Portal', 'Job_Posts']]
 
     colors = ['red', 'blue', 'green']
@@ -51,90 +194,107 @@ def recruiters_portal_ranking_plots(df):
         plt.Line2D([0], [0], color=colors[2], label='Rank 3')
     ]
     plt.legend(handles=legend_elements, loc='upper right')
-    _, col1, _ = st.columns([0.5, 2, 0.5])
-    with col1:
-        st.pyplot(fig)
+    return fig
 
 
-def min_experience_plot(df):
+def min_experience_plot():
     """
     Creates a bar chart displaying job counts by
     degree and year for a selected experience level, with interactive filters.
+    The filters are applied by a query on the MinimumExperience table.
     """
+    experience_levels = dd.distinct_values('MinimumExperience', 'Min_experience')
+    years = dd.distinct_values('MinimumExperience', 'Year')
+    degrees = dd.distinct_values('MinimumExperience', 'Qualifications')
     col1, _, col2 = st.columns([3, 0.2, 1])
     with col2:
         st.markdown("Filters:")
-        selected_experience = st.selectbox('Select Experience Level:', sorted(df['Min_experience'].unique()), index=0)
-        selected_years = st.multiselect('Select Years:', sorted(df['Year'].unique()),
-                                        default=sorted(df['Year'].unique()))
-        selected_degrees = st.multiselect('Select Qualifications:', sorted(df['Qualifications'].unique()),
-                                          default=sorted(df['Qualifications'].unique()))
+        selected_experience = st.selectbox('Select Experience Level:', experience_levels, index=0)
+        selected_years = st.multiselect('Select Years:', years, default=years)
+        selected_degrees = st.multiselect('Select Qualifications:', degrees, default=degrees)
 
     with col1:
-        filtered_df = df[(df['Year'].isin(selected_years)) & (df['Qualifications'].isin(selected_degrees)) & (
-                df['Min_experience'] == selected_experience)]
-
-        basic_colors = ['blue', 'red', 'orange', 'green', 'purple', 'cyan', 'magenta', 'lime', 'pink', 'gray']
-        qualification_colors = {degree: basic_colors[i % len(basic_colors)] for i, degree in
-                                enumerate(sorted(df['Qualifications'].unique()))}
-
-        fig, ax = plt.subplots(figsize=(12, 6))
-        positions = []
-        labels = []
-        added_labels = []
-        for (degree, year), group in filtered_df.groupby(['Qualifications', 'Year']):
-            position = f'{degree} {year}'
-            positions.append(position)
-            labels.append(f'{year}')
-            job_count = group['Job_count'].sum()
-            ax.bar(position, job_count, width=0.4, color=qualification_colors[degree],
-                   label=degree if degree not in added_labels else "_nolegend_")
-            added_labels.append(degree)
-
-        ax.set_xlabel('Degree and Year')
-        ax.set_ylabel('Job count')
-        ax.set_title('Job count by degree and year for a specific experience level')
-        ax.set_xticks(positions)
-        ax.set_xticklabels(labels, rotation=45, ha="right", fontweight='bold')
-        if len(added_labels)>0:
-            ax.legend()
-        st.pyplot(fig)
-
-
-def discrimination_posts_plot(df):
+        filtered_df = dd.min_experience_counts(selected_experience, selected_years, selected_degrees)
+
+        rendered = cached_render(
+            render_key('min_experience', filtered_df, degrees=degrees),
+            lambda: min_experience_figure(filtered_df, degrees))
+        show_figure(rendered)
+
+
+def min_experience_figure(filtered_df, degrees):
+
+    """Builds the bar chart figure of min_experience_plot, every degree keeps its color."""
+
+    import matplotlib.pyplot as plt
+    basic_colors = ['blue', 'red', 'orange', 'green', 'purple', 'cyan', 'magenta', 'lime', 'pink', 'gray']
+    qualification_colors = {degree: basic_colors[i % len(basic_colors)] for i, degree in
+                            enumerate(degrees)}
+
+    fig, ax = plt.subplots(figsize=(12, 6))
+    positions = []
+    labels = []
+    added_labels = []
+    for degree, year, job_count in filtered_df[['Qualifications', 'Year', 'Job_count']].itertuples(index=False):
+        position = f'{degree} {year}'
+        positions.append(position)
+        labels.append(f'{year}')
+        ax.bar(position, job_count, width=0.4, color=qualification_colors[degree],
+               label=degree if degree not in added_labels else "_nolegend_")
+        added_labels.append(degree)
+
+    ax.set_xlabel('Degree and Year')
+    ax.set_ylabel('Job count')
+    ax.set_title('Job count by degree and year for a specific experience level')
+    ax.set_xticks(positions)
+    ax.set_xticklabels(labels, rotation=45, ha="right", fontweight='bold')
+    if len(added_labels)>0:
+        ax.legend()
+    return fig
+
+
+def discrimination_posts_plot():
 
     """
     Visualizes job availability by country based on gender preferences and
     qualifications using an interactive choropleth map.
+    The filters are applied by a query on the Discrimination table.
     """
 
-    df['Job_Count'] = pd.to_numeric(df['Job_Count'], errors='coerce').fillna(0)
     col1_filter, col2_filter, col3_filter = st.columns(3)
     with col1_filter:
         selected_countries = st.selectbox(
             "Select Countries",
-            options=df['Country'].unique(),
+            options=dd.distinct_values('Discrimination', 'Country'),
         )
 
     with col2_filter:
         selected_preferences = st.selectbox(
             "Select Gender Preferences",
-            options=df['Preference'].unique(),
+            options=dd.distinct_values('Discrimination', 'Preference'),
         )
 
     with col3_filter:
         selected_qualifications = st.multiselect(
             "Select Qualifications",
-            options=df['Qualifications'].unique(),
+            options=dd.distinct_values('Discrimination', 'Qualifications'),
         )
 
-    filtered_df = df[
-        (df['Country'] == selected_countries) &
-        (df['Preference'] == selected_preferences) &
-        df['Qualifications'].isin(selected_qualifications)
-        ]
-    country_gender_jobs_filtered = filtered_df.groupby('Country', as_index=False)['Job_Count'].mean()
+    filtered_df = dd.discrimination_rows(selected_countries, selected_preferences, selected_qualifications)
+    country_gender_jobs_filtered = dd.discrimination_average(selected_countries, selected_preferences,
+                                                             selected_qualifications)
+
+    rendered = cached_render(render_key('discrimination_posts', country_gender_jobs_filtered),
+                             lambda: discrimination_posts_figure(country_gender_jobs_filtered))
+    show_figure(rendered)
+    st.write("Filtered Data:", filtered_df)
+
+
+def discrimination_posts_figure(country_gender_jobs_filtered):
 
+    """Builds the choropleth figure of discrimination_posts_plot."""
+
+    import plotly.express as px
     geo_fig = px.choropleth(
         country_gender_jobs_filtered,
         locations="Country",
@@ -151,9 +311,7 @@ def discrimination_posts_plot(df):
         geo=dict(showcoastlines=True, coastlinecolor="Black"),
         height=600
     )
-
-    st.plotly_chart(geo_fig)
-    st.write("Filtered Data:", filtered_df)
+    return geo_fig
 
 
 def under_min_salary_plot(df):
@@ -161,6 +319,18 @@ def under_min_salary_plot(df):
     Generates a word cloud representing the distribution of job postings
      by companies offering salaries below the minimum threshold.
      """
+    rendered = cached_render(render_key('under_min_salary', df), lambda: under_min_salary_figure(df))
+    _, col1, _ = st.columns([0.1, 2, 0.5])
+    with col1:
+        show_figure(rendered)
+
+
+def under_min_salary_figure(df):
+
+    """Builds the word cloud figure of under_min_salary_plot."""
+
+    import matplotlib.pyplot as plt
+    from wordcloud import WordCloud
     company_salary_counts = df['Company'].value_counts().to_dict()
 
     wordcloud = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(company_salary_counts)
@@ -168,9 +338,7 @@ def under_min_salary_plot(df):
     fig = plt.figure(figsize=(12, 10))
     plt.imshow(wordcloud, interpolation='bilinear')
     plt.axis('off')
-    _, col1, _ = st.columns([0.1, 2, 0.5])
-    with col1:
-        st.pyplot(fig)
+    return fig
 
 
 def leading_countries_job_posts(df):
@@ -178,13 +346,139 @@ def leading_countries_job_posts(df):
     Displays a treemap of the top 5 companies per country based on job postings
     highlighting job distribution across leading countries.
     """
+    rendered = cached_render(render_key('leading_countries', df), lambda: leading_countries_figure(df))
     _, col1, _ = st.columns([0.5,2,0.5])
     with col1:
-        fig = px.treemap(df,
-                         path=['Country', 'Company'],
-                         values='Job_Count',
-                         color='Total_Jobs',
-                         hover_data=['Company', 'Total_Jobs'],
-                         color_continuous_scale='Greens',
-                         title="Top 5 Companies per Country - Treemap")
-        st.plotly_chart(fig)
+        show_figure(rendered)
+
+
+def leading_countries_figure(df):
+
+    """Builds the treemap figure of leading_countries_job_posts."""
+
+    import plotly.express as px
+    return px.treemap(df,
+                      path=['Country', 'Company'],
+                      values='Job_Count',
+                      color='Total_Jobs',
+                      hover_data=['Company', 'Total_Jobs'],
+                      color_continuous_scale='Greens',
+                      title="Top 5 Companies per Country - Treemap")
+
+
+def job_market_cube_plot():
+    """
+    Draws the job count of any slice of the job market cube: the selected dimensions
+    are grouped, the other dimensions can be filtered to selected values.
+    """
+    col1, _, col2 = st.columns([3, 0.2, 1])
+    with col2:
+        st.markdown("Filters:")
+        group_by = st.multiselect('Group By:', dd.CUBE_DIMENSIONS, default=['Country'])
+        filters = {}
+        for dimension in dd.CUBE_DIMENSIONS:
+            selected = st.multiselect(f'Select {dimension}:', dd.cube_values(dimension))
+            if selected:
+                filters[dimension] = selected
+
+    with col1:
+        slice_df = dd.cube_slice(group_by, filters)
+        if group_by and len(slice_df) > 0:
+            rendered = cached_render(render_key('job_market_cube', slice_df, group_by=tuple(group_by)),
+                                     lambda: job_market_cube_figure(slice_df, group_by))
+            show_figure(rendered)
+        st.write("Slice:", slice_df)
+
+
+def job_market_cube_figure(slice_df, group_by):
+
+    """Builds the bar chart of job_market_cube_plot, the 50 largest groups by the first dimension and colored by the second."""
+
+    import plotly.express as px
+    top = slice_df.nlargest(50, 'Job_Count').astype({dimension: str for dimension in group_by})
+    return px.bar(top, x=group_by[0], y='Job_Count', color=group_by[1] if len(group_by) > 1 else None,
+                  hover_data=group_by[2:] + ['Avg_Min_Salary', 'Avg_Max_Salary'],
+                  labels={'Job_Count': 'Number of Jobs'}, title="Job Posts per Slice")
+
+
+def pipeline_performance_plot(df):
+    """
+    Draws a line per pipeline step of the selected metric across the runs,
+    and shows the DuckDB profile of a selected step run.
+    """
+    metrics = {'Wall time (s)': 'Wall_Seconds', 'Peak memory (MB)': 'Peak_Memory_MB',
+               'Rows in': 'Rows_In', 'Rows out': 'Rows_Out'}
+    steps = sorted(df['Step'].unique())
+    col1, _, col2 = st.columns([3, 0.2, 1])
+    with col2:
+        st.markdown("Filters:")
+        selected_metric = st.selectbox('Select Metric:', list(metrics))
+        selected_steps = st.multiselect('Select Steps:', steps, default=steps)
+
+    with col1:
+        trend = df[df['Step'].isin(selected_steps)][['Run_Started', 'Step', metrics[selected_metric]]]
+        rendered = cached_render(render_key('pipeline_performance', trend, metric=selected_metric),
+                                 lambda: pipeline_performance_figure(trend, metrics[selected_metric],
+                                                                     selected_metric))
+        show_figure(rendered)
+
+    profiled = df[df['Profile'].notna()].sort_values('Run_Started', ascending=False)
+    if len(profiled) > 0:
+        with st.expander("DuckDB profile (EXPLAIN ANALYZE)"):
+            labels = [f"{run} - {step}" for run, step in zip(profiled['Run_Id'], profiled['Step'])]
+            selected = st.selectbox('Select Run and Step:', range(len(labels)), format_func=lambda i: labels[i])
+            st.json(profiled['Profile'].iloc[selected])
+
+
+def pipeline_performance_figure(trend, column, label):
+
+    """Builds the line chart figure of pipeline_performance_plot."""
+
+    import plotly.express as px
+    return px.line(trend.sort_values('Run_Started'), x='Run_Started', y=column, color='Step', markers=True,
+                   labels={column: label, 'Run_Started': 'Run'},
+                   title=f"{label} per pipeline step across runs")
+
+
+def default_renders():
+
+    """
+    Returns the render key and the render function of every figure, with the data and the filters the pages
+    start with (the first option of a select box, all the options of a multiselect that defaults to all of them),
+    so prewarm.py can render the figures a new session sees first.
+    """
+
+    renders = {}
+    ratings = dd.load_table('JobMarketRatings')
+    renders['recruiters_portal_ranking'] = (render_key('recruiters_portal_ranking', ratings),
+                                            lambda: recruiters_portal_ranking_figure(ratings))
+
+    degrees = dd.distinct_values('MinimumExperience', 'Qualifications')
+    experience = dd.distinct_values('MinimumExperience', 'Min_experience')[0]
+    counts = dd.min_experience_counts(experience, dd.distinct_values('MinimumExperience', 'Year'), degrees)
+    renders['min_experience'] = (render_key('min_experience', counts, degrees=degrees),
+                                 lambda: min_experience_figure(counts, degrees))
+
+    average = dd.discrimination_average(dd.distinct_values('Discrimination', 'Country')[0],
+                                        dd.distinct_values('Discrimination', 'Preference')[0], [])
+    renders['discrimination_posts'] = (render_key('discrimination_posts', average),
+                                       lambda: discrimination_posts_figure(average))
+
+    under_minimum = dd.load_table('UnderMinimum')
+    renders['under_min_salary'] = (render_key('under_min_salary', under_minimum),
+                                   lambda: under_min_salary_figure(under_minimum))
+
+    top_countries = dd.load_table('TopCountriesJobPosts')
+    renders['leading_countries'] = (render_key('leading_countries', top_countries),
+                                    lambda: leading_countries_figure(top_countries))
+
+    slice_df = dd.cube_slice(['Country'])
+    if len(slice_df) > 0:
+        renders['job_market_cube'] = (render_key('job_market_cube', slice_df, group_by=('Country',)),
+                                      lambda: job_market_cube_figure(slice_df, ['Country']))
+
+    metrics = dd.load_table('PipelineMetrics')
+    trend = metrics[metrics['Step'].isin(metrics['Step'].unique())][['Run_Started', 'Step', 'Wall_Seconds']]
+    renders['pipeline_performance'] = (render_key('pipeline_performance', trend, metric='Wall time (s)'),
+                                       lambda: pipeline_performance_figure(trend, 'Wall_Seconds', 'Wall time (s)'))
+    return renders
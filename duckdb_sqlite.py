@@ -8,23 +8,581 @@ Here we run our queries on the data set and load the tables into duckdb
 and copy the small data sets into sqlite file
 """
 
+import argparse
 import duckdb
+import glob
+import hashlib
+import jobs_cube
+import json
+import multiprocessing
 import os
+import pipeline_metrics
+import query_cache
+import sampling
+import search_index
+import shutil
+import snapshots
+import sqlite3
+import tempfile
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-# Create a connection to an DuckDB database in memory
-connection = duckdb.connect("db_file.duckdb")
-connection.execute("""
-    CREATE TABLE IF NOT EXISTS JobsData AS
-    SELECT * FROM read_csv_auto('job_descriptions.csv')
-""")
+# the csv source of JobsData - a single file or a glob pattern of feed files (e.g. 'feed/*.csv')
+CSV_SOURCE = "job_descriptions.csv"
 
-# create sample 500 rows tables out of our original JobsData
-connection.execute(
+# the directory of the typed parquet copy of JobsData, this is what the queries read
+STAGING_DIR = "staging"
+
+# the hive partitioned layout of the staged data: STAGING_DIR/partitioned/Country=.../Posting_Year=.../part-*.parquet
+PARTITIONED_DIR = os.path.join(STAGING_DIR, "partitioned")
+PARTITION_COLUMNS = {"Country": "VARCHAR", "Posting_Year": "INTEGER"}
+
+# every ingest batch adds a file to each partition it has rows of, a partition with more than COMPACT_MIN_FILES
+# files smaller than COMPACT_FILE_BYTES gets them rewritten as one file
+COMPACT_MIN_FILES = 8
+COMPACT_FILE_BYTES = 8 * 1024 * 1024
+
+# the string columns we parse only once, when a batch is staged
+STAGED_COLUMNS = """
+    TRY_CAST(SPLIT_PART(Experience, ' to ', 1) AS INTEGER) AS Min_Experience,
+    TRY_CAST(SPLIT_PART(SPLIT_PART(Experience, ' to ', 2), ' ', 1) AS INTEGER) AS Max_Experience,
+    TRY_CAST(SPLIT_PART(REPLACE(REPLACE("Salary Range", '$', ''), 'K', ''), '-', 1) AS INTEGER) * 1000 AS Min_Salary,
+    TRY_CAST(SPLIT_PART(REPLACE(REPLACE("Salary Range", '$', ''), 'K', ''), '-', 2) AS INTEGER) * 1000 AS Max_Salary
+"""
+
+# the bytes of a csv file before its watermark that are compared to tell a file that only had rows
+# appended from a file that was rewritten
+TAIL_CHECK_BYTES = 4096
+
+# the DuckDB database file of the pipeline
+DUCKDB_FILE = "db_file.duckdb"
+
+# the "small" database the dashboard reads
+SQLITE_FILE = "db_file.sqlite"
+
+# the DuckDB database the Explore and Search pages query, written into every snapshot (createExploreDatabase)
+EXPLORE_FILE = "explore.duckdb"
+
+# the exported tables as uncompressed Arrow IPC files, the dashboard memory maps them
+ARROW_DIR = "arrow_tables"
+
+# the tables the dashboard only queries with sql and never loads whole, they are not written as Arrow files
+SQL_ONLY_TABLES = ("JobsCube",)
+
+# string columns with at most this ratio of distinct values to rows are dictionary encoded in the Arrow files
+DICTIONARY_MAX_RATIO = 0.5
+
+# sqlite table -> the DuckDB table it is copied from
+EXPORT_TABLES = {
+    "SampleJobsData": "SampleJobsData",
+    "SampleByPortal": "SampleByPortal",
+    "TopCountriesJobPosts": "TopCountriesJobPosts",
+    "MinimumExperience": "MinimumExperience",
+    "Discrimination": "Discrimination",
+    "JobMarketRatings": "JobMarketRating",
+    "UnderMinimum": "UnderMinimum",
+    "JobsCube": "JobsCube",
+    "PipelineMetrics": "PipelineMetrics",
+    # only exported once an --approximate run created them, removed again by the next exact run
+    "TopCountriesJobPostsApprox": "TopCountriesJobPostsApprox",
+    "DiscriminationApprox": "DiscriminationApprox",
+    "JobMarketRatingsApprox": "JobMarketRatingApprox",
+}
+
+# sqlite table -> the indexes (column lists) on the columns the dashboard filters by
+EXPORT_INDEXES = {
+    "TopCountriesJobPosts": [["Country"]],
+    "MinimumExperience": [["Min_experience", "Year", "Qualifications"]],
+    "Discrimination": [["Country", "Preference", "Qualifications"], ["Qualifications"]],
+    "JobMarketRatings": [["Portal"]],
+    "JobsCube": [["Grouping_Id", "Country", "Preference"], ["Grouping_Id", "Year"]],
+    "PipelineMetrics": [["Step", "Run_Started"]],
+}
+
+# the connection to the DuckDB database, opened by openDatabase()
+connection = None
+
+
+# -------------- openDatabase--------------
+def openDatabase(databaseFile=DUCKDB_FILE, config=None):
     """
-    CREATE TABLE IF NOT EXISTS SampleJobsData AS
-    SELECT * FROM JobsData USING SAMPLE 500;
+    opens the connection that all the pipeline functions use
+    :param databaseFile: the DuckDB database file
+    :param config: the DuckDB execution settings, e.g. memory_limit, threads, temp_directory
+                   and preserve_insertion_order (see executionConfig)
+    :return: the connection
     """
-)
+    global connection
+    connection = duckdb.connect(databaseFile, config=config or {})
+    return connection
+
+
+# -------------- executionConfig--------------
+def executionConfig(memoryLimit=None, threads=None, tempDirectory=None, preserveInsertionOrder=True):
+    """
+    the execution profile of a worker node. with a memory limit DuckDB spills the large
+    aggregations, sorts and windows (e.g. query4) to tempDirectory instead of running out of memory,
+    and not preserving the insertion order lets it stream results with much less memory.
+    :return: the DuckDB config of the profile
+    """
+    config = {"preserve_insertion_order": preserveInsertionOrder}
+    if memoryLimit:
+        config["memory_limit"] = memoryLimit
+    if threads:
+        config["threads"] = threads
+    if tempDirectory:
+        config["temp_directory"] = tempDirectory
+    return config
+
+
+# -------------- sqlFileList--------------
+def sqlFileList(files):
+    """
+    :param files: list of file paths
+    :return: the files as a duckdb list literal, e.g. ['a.csv', 'b.csv']
+    """
+    quoted = ["'" + file.replace("'", "''") + "'" for file in files]
+    return "[" + ", ".join(quoted) + "]"
+
+
+# -------------- tableExists--------------
+def tableExists(tableName):
+    """
+    :param tableName: the name of the table
+    :return: True if the table exists in the database (temp tables are not counted)
+    """
+    return connection.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = ? AND NOT temporary", [tableName]
+    ).fetchone()[0] > 0
+
+
+# -------------- csvReader--------------
+def csvReader(files):
+    """
+    the first load sniffs the csv schema, after that the column types of JobsData are reused
+    so every new file is read with the same types and without inferring them again.
+    :param files: list of csv file paths
+    :return: the read_csv table function for the files
+    """
+    if not tableExists("JobsData"):
+        return f"read_csv_auto({sqlFileList(files)}, union_by_name = true, filename = true)"
+    columns = connection.execute("""
+        SELECT column_name, data_type FROM duckdb_columns()
+        WHERE table_name = 'JobsData' AND database_name = current_database()
+        ORDER BY column_index
+    """).fetchall()
+    columnTypes = ", ".join(
+        "'" + name.replace("'", "''") + "': '" + dataType + "'" for name, dataType in columns
+    )
+    return f"read_csv({sqlFileList(files)}, header = true, columns = {{{columnTypes}}}, filename = true)"
+
+
+# -------------- stagedSelect--------------
+def stagedSelect(sourceTable, withFilename=False):
+    """
+    :param sourceTable: a table with raw JobsData rows (JobsData, IngestBatch or a read_csv table function)
+    :param withFilename: the rows carry the csv file name they came from (read with filename = true),
+                         it is not part of the data
+    :return: the query that returns the rows of sourceTable with the typed staging columns
+    """
+    excludeColumns = "EXCLUDE (filename) " if withFilename else ""
+    return f"""
+        SELECT * {excludeColumns}REPLACE (CAST("Job Posting Date" AS DATE) AS "Job Posting Date"),
+               {STAGED_COLUMNS}
+        FROM {sourceTable}
+    """
+
+
+# -------------- stageBatch--------------
+def stageBatch(sourceTable, partitioned=False):
+    """
+    this function writes the rows of sourceTable as a new zstd compressed parquet part in STAGING_DIR,
+    with "Job Posting Date" cast to DATE and Experience and "Salary Range" parsed to typed columns.
+    the part is recorded in the StagedParts table in the caller transaction, so a part written by
+    a run that did not commit is removed by the next run.
+    :param sourceTable: the table with the new raw rows (JobsData or IngestBatch)
+    :param partitioned: write the part hive partitioned by Country and posting year (under PARTITIONED_DIR),
+                        one file per partition, sorted by the posting date so the min/max statistics
+                        of the row groups are tight. StagedParts then records the glob of its files.
+    """
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    query = stagedSelect(sourceTable, sourceTable == "IngestBatch")
+    if partitioned:
+        writePartitioned(f"""
+            SELECT *, CAST(EXTRACT(YEAR FROM "Job Posting Date") AS INTEGER) AS Posting_Year
+            FROM ({query})
+        """)
+    else:
+        partNumber = connection.execute("SELECT COALESCE(MAX(Part), 0) + 1 FROM StagedParts").fetchone()[0]
+        partFile = os.path.join(STAGING_DIR, f"part-{partNumber:05d}.parquet")
+        connection.execute(f"COPY ({query}) TO '{partFile}' (FORMAT PARQUET, COMPRESSION ZSTD)")
+        connection.execute("INSERT INTO StagedParts VALUES (?, ?)", [partNumber, partFile])
+
+
+# -------------- writePartitioned--------------
+def writePartitioned(query):
+    """
+    writes the rows of query as a new part in the hive partitioned layout, one file per partition,
+    and records the glob of its files in StagedParts (in the caller transaction)
+    :param query: a query with the staged columns and Posting_Year
+    :return: the number of the part
+    """
+    partNumber = connection.execute("SELECT COALESCE(MAX(Part), 0) + 1 FROM StagedParts").fetchone()[0]
+    connection.execute(f"""
+        COPY (
+            SELECT * FROM ({query})
+            ORDER BY Country, Posting_Year, "Job Posting Date"
+        ) TO '{PARTITIONED_DIR}' (
+            FORMAT PARQUET, COMPRESSION ZSTD, PARTITION_BY ({', '.join(PARTITION_COLUMNS)}),
+            FILENAME_PATTERN 'part-{partNumber:05d}-{{i}}', OVERWRITE_OR_IGNORE
+        )
+    """)
+    partFile = os.path.join(PARTITIONED_DIR, "**", f"part-{partNumber:05d}-*.parquet")
+    connection.execute("INSERT INTO StagedParts VALUES (?, ?)", [partNumber, partFile])
+    return partNumber
+
+
+# -------------- stagedFiles--------------
+def stagedFiles():
+    """
+    :return: the parquet files of the committed staged parts, without the files a compaction replaced
+    """
+    compactedFiles = set(file for (file,) in connection.execute("SELECT File FROM CompactedFiles").fetchall())
+    files = []
+    for (partFile,) in connection.execute("SELECT File FROM StagedParts ORDER BY Part").fetchall():
+        files.extend(file for file in sorted(glob.glob(partFile, recursive=True)) if file not in compactedFiles)
+    return files
+
+
+# -------------- stagedRowCount--------------
+def stagedRowCount():
+    """
+    :return: the number of rows of the staged parquet files, read from their footers without a scan
+    """
+    files = stagedFiles()
+    if not files:
+        return 0
+    return connection.execute(
+        f"SELECT SUM(num_rows) FROM parquet_file_metadata({sqlFileList(files)})"
+    ).fetchone()[0]
+
+
+# -------------- compactPartitions--------------
+def compactPartitions():
+    """
+    rewrites the small files of every partition of the hive partitioned layout that has more than
+    COMPACT_MIN_FILES files smaller than COMPACT_FILE_BYTES as one file, in a new staged part.
+    the replaced files are recorded in CompactedFiles in the same transaction, so they are no longer
+    staged files, and are removed after the commit (or by refreshStaging of the next run).
+    a file that reached COMPACT_FILE_BYTES is not rewritten again, so the bytes a compaction rewrites
+    do not grow with the history.
+    :return: the number of compacted partitions
+    """
+    smallFiles = {}
+    for file in stagedFiles():
+        if file.startswith(PARTITIONED_DIR + os.sep) and os.path.getsize(file) < COMPACT_FILE_BYTES:
+            smallFiles.setdefault(os.path.dirname(file), []).append(file)
+    compacted = [files for files in smallFiles.values() if len(files) > COMPACT_MIN_FILES]
+    if not compacted:
+        return 0
+
+    files = [file for partitionFiles in compacted for file in partitionFiles]
+    connection.execute("BEGIN TRANSACTION")
+    writePartitioned(f"SELECT * FROM {stagedReader(sqlFileList(files), True)}")
+    connection.executemany("INSERT INTO CompactedFiles VALUES (?)", [[file] for file in files])
+    connection.execute("COMMIT")
+    for file in files:
+        os.remove(file)
+    connection.execute("DELETE FROM CompactedFiles")
+    return len(compacted)
+
+
+# -------------- refreshStaging--------------
+def refreshStaging(partitioned=False):
+    """
+    removes parts that were never committed and the files compactPartitions replaced, stages the whole
+    of JobsData when there are no parts yet (first run) and creates the JobsStaged view over the parquet parts.
+    when the staged parts are in the other layout than requested, JobsData is staged again.
+    :param partitioned: use the hive partitioned layout, filters on Country and Posting_Year
+                        then read only the matching partitions
+    """
+    committedParts = [file for (file,) in connection.execute("SELECT File FROM StagedParts").fetchall()]
+    if any(file.startswith(PARTITIONED_DIR + os.sep) != partitioned for file in committedParts):
+        connection.execute("DELETE FROM StagedParts")
+        committedParts = []
+
+    committedFiles = set(stagedFiles())
+    for file in glob.glob(os.path.join(STAGING_DIR, "**", "part-*.parquet"), recursive=True):
+        if file not in committedFiles:
+            os.remove(file)
+    # the files a compaction replaced are gone now
+    connection.execute("DELETE FROM CompactedFiles")
+    if not partitioned and os.path.isdir(PARTITIONED_DIR):
+        # only the empty partition directories of the other layout are left
+        shutil.rmtree(PARTITIONED_DIR)
+
+    if not committedParts and tableExists("JobsData"):
+        connection.execute("BEGIN TRANSACTION")
+        stageBatch("JobsData", partitioned)
+        connection.execute("COMMIT")
+
+    if partitioned:
+        source = stagedReader(f"'{os.path.join(PARTITIONED_DIR, '**', '*.parquet')}'", True)
+    else:
+        source = stagedReader(f"'{os.path.join(STAGING_DIR, 'part-*.parquet')}'")
+    connection.execute(f"CREATE OR REPLACE VIEW JobsStaged AS SELECT * FROM {source}")
+
+
+# -------------- stagedReader--------------
+def stagedReader(files, partitioned=False, fileRowNumber=False):
+    """
+    :param files: a quoted glob or a list literal (sqlFileList) of staged parquet parts
+    :param partitioned: the parts are in the hive partitioned layout
+    :param fileRowNumber: add the file_row_number column, the position of the row in its file
+    :return: the read_parquet table function of the parts, with the partition columns of the partitioned layout
+    """
+    options = ", file_row_number = true" if fileRowNumber else ""
+    if not partitioned:
+        return f"read_parquet({files}{options})"
+    hiveTypes = ", ".join(f"'{column}': {columnType}" for column, columnType in PARTITION_COLUMNS.items())
+    return f"read_parquet({files}, hive_partitioning = true, hive_types = {{{hiveTypes}}}{options})"
+
+
+# -------------- streamCsv--------------
+def streamCsv(source):
+    """
+    the streaming mode: JobsStaged becomes a view over the csv files themselves, so the queries
+    read and parse the (sharded) files directly and JobsData is not materialized at all.
+    :param source: path or glob pattern of the csv files
+    :return: the csv files
+    """
+    files = sorted(glob.glob(source))
+    if not files:
+        raise FileNotFoundError(f"no csv files match {source}")
+    connection.execute(f"CREATE OR REPLACE VIEW JobsStaged AS {stagedSelect(csvReader(files), True)}")
+    return files
+
+
+# -------------- fileTailHash--------------
+def fileTailHash(file, size):
+    """
+    :param file: a csv file
+    :param size: the watermark of the file, the number of its bytes that were loaded
+    :return: the hash of the TAIL_CHECK_BYTES bytes of the file before size, None when they do not end
+             with a new line (size is not the end of a row, the rows after it cannot be read on their own)
+    """
+    start = max(0, size - TAIL_CHECK_BYTES)
+    with open(file, "rb") as handle:
+        handle.seek(start)
+        tail = handle.read(size - start)
+    return hashlib.sha256(tail).hexdigest() if tail.endswith(b"\n") else None
+
+
+# -------------- writeTail--------------
+def writeTail(file, offset, size, tailFile):
+    """
+    writes the header line of a csv file and its bytes from offset to size into tailFile,
+    so the rows appended after offset are parsed without parsing the rows before them again
+    """
+    with open(file, "rb") as source, open(tailFile, "wb") as target:
+        target.write(source.readline())
+        source.seek(offset)
+        target.write(source.read(size - offset))
+
+
+# -------------- ingestCsv--------------
+def ingestCsv(source, partitioned=False):
+    """
+    this function incrementally loads the csv files of source into the JobsData table.
+    for every file we keep a watermark (size and modification time) in the IngestWatermark table,
+    files that did not change since the last run are not read at all.
+    a file that only grew, and whose bytes before the watermark are the same (fileTailHash), had rows
+    appended: only its bytes after the watermark are read. any other changed file is read again whole.
+    the rows are read into the IngestBatch temp table, only the first row of every "Job Id" is kept and
+    rows whose "Job Id" is already in JobsData are dropped, so only the delta is appended.
+    :param source: path or glob pattern of the csv files
+    :param partitioned: stage the new rows in the hive partitioned layout (see stageBatch)
+    :return: the number of rows appended to JobsData
+    """
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS IngestWatermark (
+            File VARCHAR PRIMARY KEY,
+            Size BIGINT,
+            Modified DOUBLE,
+            Rows_Loaded BIGINT,
+            Loaded_At TIMESTAMP
+        )
+    """)
+    connection.execute("ALTER TABLE IngestWatermark ADD COLUMN IF NOT EXISTS Tail_Hash VARCHAR")
+    connection.execute("CREATE TABLE IF NOT EXISTS StagedParts (Part INTEGER PRIMARY KEY, File VARCHAR)")
+    connection.execute("CREATE TABLE IF NOT EXISTS CompactedFiles (File VARCHAR)")
+    watermarks = dict(
+        (file, (size, modified, rowsLoaded, tailHash)) for file, size, modified, rowsLoaded, tailHash in
+        connection.execute("SELECT File, Size, Modified, Rows_Loaded, Tail_Hash FROM IngestWatermark").fetchall()
+    )
+
+    # (file, size, modification time, the offset it is read from)
+    changedFiles = []
+    for file in sorted(glob.glob(source)):
+        stat = os.stat(file)
+        watermark = watermarks.get(file)
+        if watermark is not None and watermark[:2] == (stat.st_size, stat.st_mtime):
+            continue
+        offset = 0
+        if (watermark is not None and watermark[3] is not None and 0 < watermark[0] <= stat.st_size
+                and watermark[3] == fileTailHash(file, watermark[0])):
+            offset = watermark[0]
+        changedFiles.append((file, stat.st_size, stat.st_mtime, offset))
+
+    connection.execute("DROP TABLE IF EXISTS IngestBatch")
+    if not changedFiles:
+        return 0
+
+    jobsDataExists = tableExists("JobsData")
+    tailDir = tempfile.mkdtemp(prefix="ingest-")
+    try:
+        # the appended bytes of a file are read from a copy of its tail, named after the file
+        readFiles = {}
+        for number, (file, size, _, offset) in enumerate(changedFiles):
+            if offset == 0:
+                readFiles[file] = file
+            elif size > offset:
+                tailFile = os.path.join(tailDir, f"tail-{number:05d}.csv")
+                writeTail(file, offset, size, tailFile)
+                readFiles[tailFile] = file
+
+        connection.execute("BEGIN TRANSACTION")
+        rowsRead = {}
+        if readFiles:
+            connection.execute(f"CREATE TEMP TABLE IngestBatch AS SELECT * FROM {csvReader(list(readFiles))}")
+            for readFile, file in readFiles.items():
+                if readFile != file:
+                    connection.execute("UPDATE IngestBatch SET filename = ? WHERE filename = ?", [file, readFile])
+            rowsRead = dict(connection.execute("SELECT filename, COUNT(*) FROM IngestBatch GROUP BY filename").fetchall())
+    finally:
+        shutil.rmtree(tailDir, ignore_errors=True)
+
+    newRows = 0
+    if readFiles:
+        # a job id that appears more than once in the batch (in one file or in several) is loaded once
+        connection.execute("""
+            DELETE FROM IngestBatch
+            WHERE rowid NOT IN (SELECT MIN(rowid) FROM IngestBatch GROUP BY "Job Id")
+        """)
+        if jobsDataExists:
+            # re-delivered files contain rows we already have, keep only the new job ids
+            connection.execute("""
+                DELETE FROM IngestBatch
+                WHERE "Job Id" IN (SELECT "Job Id" FROM JobsData)
+            """)
+            connection.execute("INSERT INTO JobsData BY NAME SELECT * EXCLUDE (filename) FROM IngestBatch")
+        else:
+            connection.execute("CREATE TABLE JobsData AS SELECT * EXCLUDE (filename) FROM IngestBatch")
+
+        newRows = connection.execute("SELECT COUNT(*) FROM IngestBatch").fetchone()[0]
+        # a batch of only known job ids adds no part, the staged files and their fingerprint stay the same
+        if newRows > 0 and jobsDataExists and connection.execute("SELECT COUNT(*) FROM StagedParts").fetchone()[0] > 0:
+            stageBatch("IngestBatch", partitioned)
+
+    # Rows_Loaded counts the rows of the file up to Size, with the rows before the watermark of an appended file
+    for file, size, modified, offset in changedFiles:
+        rowsLoaded = rowsRead.get(file, 0) + (watermarks[file][2] if offset > 0 else 0)
+        connection.execute(
+            "INSERT OR REPLACE INTO IngestWatermark BY NAME "
+            "SELECT ? AS File, ? AS Size, ? AS Modified, ? AS Rows_Loaded, current_localtimestamp() AS Loaded_At, "
+            "? AS Tail_Hash",
+            [file, size, modified, rowsLoaded, fileTailHash(file, size)]
+        )
+    connection.execute("COMMIT")
+    return newRows
+
+
+# -------------- lastBatch--------------
+def lastBatch():
+    """
+    the tables that follow JobsData batch by batch (samples, search index, base count tables) need the
+    rows this run loaded and the number of rows they should count after the batch
+    :return: the subquery of the rows of the last ingest batch (None when this run loaded nothing) and
+             the number of JobsData rows
+    """
+    batchExists = connection.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'IngestBatch' AND temporary"
+    ).fetchone()[0] > 0
+    batch = "(SELECT * EXCLUDE (filename) FROM IngestBatch)" if batchExists else None
+    totalRows = connection.execute("SELECT COUNT(*) FROM JobsData").fetchone()[0]
+    return batch, totalRows
+
+
+# -------------- createSampleTable--------------
+def createSampleTable(source="JobsData"):
+    """
+    creates the stratified sample tables (sampling.SAMPLES) out of our original JobsData.
+    the rows of the last ingest batch are merged into the samples, any other source
+    (the streaming view) is sampled again on every run.
+    :param source: the table (or subquery) of the original rows
+    :return: the samples that were merged instead of rebuilt
+    """
+    if source != "JobsData":
+        return sampling.refreshSamples(connection, source)
+    batch, totalRows = lastBatch()
+    return sampling.refreshSamples(connection, "JobsData", batch, totalRows)
+
+
+# -------------- createSearchIndex--------------
+def createSearchIndex():
+    """
+    brings the full text index of JobsData (search_index.py) up to date, only the rows of the last
+    ingest batch are indexed when the index saw all the rows before them
+    :return: True when the batch was appended to the index, False when it was rebuilt
+    """
+    batch, totalRows = lastBatch()
+    return search_index.refreshSearchIndex(connection, "JobsData", batch, totalRows)
+
+
+# -------------- tableContentHash--------------
+def tableContentHash(tableName):
+    """
+    :param tableName: a DuckDB table
+    :return: a hash of the schema and the rows of the table (independent of the row order)
+    """
+    schema = connection.execute(f"DESCRIBE {tableName}").fetchall()
+    rows, rowsHash = connection.execute(f"SELECT COUNT(*), SUM(hash(t)::HUGEINT) FROM {tableName} t").fetchone()
+    content = repr([column[:2] for column in schema]) + f"|{rows}|{rowsHash}"
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+# -------------- copyTableToSqlite--------------
+def copyTableToSqlite(sqliteConnection, sqliteTable, duckdbTable):
+    """
+    (re)creates sqliteTable from duckdbTable, rows are streamed in chunks with executemany
+    """
+    sqliteTypes = []
+    selectColumns = []
+    for name, columnType, *_ in connection.execute(f"DESCRIBE {duckdbTable}").fetchall():
+        quotedName = '"' + name.replace('"', '""') + '"'
+        if columnType in ("TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT", "UTINYINT", "USMALLINT",
+                          "UINTEGER", "UBIGINT", "BOOLEAN"):
+            sqliteTypes.append(f"{quotedName} INTEGER")
+            selectColumns.append(f"CAST({quotedName} AS BIGINT)")
+        elif columnType in ("FLOAT", "DOUBLE") or columnType.startswith("DECIMAL"):
+            sqliteTypes.append(f"{quotedName} REAL")
+            selectColumns.append(f"CAST({quotedName} AS DOUBLE)")
+        else:
+            sqliteTypes.append(f"{quotedName} TEXT")
+            selectColumns.append(f"CAST({quotedName} AS VARCHAR)")
+
+    sqliteConnection.execute(f"DROP TABLE IF EXISTS {sqliteTable}")
+    sqliteConnection.execute(f"CREATE TABLE {sqliteTable} ({', '.join(sqliteTypes)})")
+    insert = f"INSERT INTO {sqliteTable} VALUES ({', '.join('?' * len(sqliteTypes))})"
+    cursor = connection.execute(f"SELECT {', '.join(selectColumns)} FROM {duckdbTable}")
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        sqliteConnection.executemany(insert, rows)
+
 
 # -------------- duckdbToSqlite--------------
 def duckdbToSqlite():
@@ -32,40 +590,216 @@ def duckdbToSqlite():
     this function creates the sqlite "small" database file
     insert into it the relevant tables.
     more details on the queries and commend in the docs file
+    the file is built next to the live one and swapped in with a rename, so readers never see
+    a half written database. only tables whose content hash (kept in ExportManifest) changed are
+    copied again, PRAGMA user_version is increased on every export as a version stamp.
+    exported tables whose DuckDB table was dropped (the stale approximate tables) are removed.
+    :return: the sqlite tables that were exported or removed
     """
-    connection.execute("""
-    ATTACH 'db_file.sqlite' AS sqlite_db (TYPE SQLITE);
-    CREATE TABLE sqlite_db.SampleJobsData AS SELECT * FROM SampleJobsData;
-    CREATE TABLE sqlite_db.TopCountriesJobPosts AS SELECT * FROM TopCountriesJobPosts ;
-    CREATE TABLE sqlite_db.MinimumExperience AS SELECT * FROM MinimumExperience;
-    CREATE TABLE sqlite_db.Discrimination AS SELECT * FROM Discrimination ;
-    CREATE TABLE sqlite_db.JobMarketRatings AS SELECT * FROM JobMarketRating;
-    CREATE TABLE sqlite_db.UnderMinimum AS SELECT * FROM UnderMinimum;
+    exportTables = dict((sqliteTable, duckdbTable) for sqliteTable, duckdbTable in EXPORT_TABLES.items()
+                        if tableExists(duckdbTable))
+    hashes = dict((sqliteTable, tableContentHash(duckdbTable)) for sqliteTable, duckdbTable in exportTables.items())
+    exportedHashes = {}
+    if os.path.exists(SQLITE_FILE):
+        liveConnection = sqlite3.connect(SQLITE_FILE)
+        try:
+            exportedHashes = dict(liveConnection.execute("SELECT Table_Name, Content_Hash FROM ExportManifest").fetchall())
+        except sqlite3.OperationalError:
+            # a database exported before we had a manifest, export everything
+            pass
+        liveConnection.close()
+    changed = [sqliteTable for sqliteTable in exportTables if exportedHashes.get(sqliteTable) != hashes[sqliteTable]]
+    removed = [sqliteTable for sqliteTable in exportedHashes if sqliteTable not in exportTables]
+    if not changed and not removed:
+        return []
+
+    tempFile = SQLITE_FILE + ".tmp"
+    if os.path.exists(tempFile):
+        os.remove(tempFile)
+    tempConnection = sqlite3.connect(tempFile)
+    if exportedHashes:
+        # start from a consistent copy of the live database and replace only the changed tables
+        liveConnection = sqlite3.connect(SQLITE_FILE)
+        liveConnection.backup(tempConnection)
+        liveConnection.close()
+
+    # nobody reads the temp file, so no journal and no fsync while loading
+    tempConnection.execute("PRAGMA journal_mode = OFF")
+    tempConnection.execute("PRAGMA synchronous = OFF")
+    tempConnection.execute("PRAGMA temp_store = MEMORY")
+    tempConnection.execute("PRAGMA cache_size = -262144")
+    tempConnection.execute("BEGIN")
+    tempConnection.execute("""
+        CREATE TABLE IF NOT EXISTS ExportManifest (Table_Name TEXT PRIMARY KEY, Content_Hash TEXT, Exported_At TEXT)
     """)
+    for sqliteTable in removed:
+        tempConnection.execute(f"DROP TABLE IF EXISTS {sqliteTable}")
+        tempConnection.execute("DELETE FROM ExportManifest WHERE Table_Name = ?", [sqliteTable])
+    for sqliteTable in changed:
+        copyTableToSqlite(tempConnection, sqliteTable, exportTables[sqliteTable])
+        for columns in EXPORT_INDEXES.get(sqliteTable, []):
+            indexName = f"idx_{sqliteTable}_{'_'.join(columns)}"
+            tempConnection.execute(f"CREATE INDEX {indexName} ON {sqliteTable} ({', '.join(columns)})")
+        tempConnection.execute(
+            "INSERT OR REPLACE INTO ExportManifest VALUES (?, ?, datetime('now'))", [sqliteTable, hashes[sqliteTable]]
+        )
+    version = tempConnection.execute("PRAGMA user_version").fetchone()[0]
+    tempConnection.execute(f"PRAGMA user_version = {version + 1}")
+    tempConnection.execute("COMMIT")
+    tempConnection.execute("ANALYZE")
+    tempConnection.close()
+
+    os.replace(tempFile, SQLITE_FILE)
+    return changed + removed
+
+
+# -------------- arrowTable--------------
+def arrowTable(duckdbTable):
+    """
+    :param duckdbTable: a DuckDB table
+    :return: the table as an Arrow table, low cardinality string columns (Country, Qualifications,
+             Preference, Portal, ...) are dictionary encoded and become categorical columns in pandas.
+             like in the sqlite export, HUGEINT columns are cast to BIGINT and DECIMAL columns to DOUBLE,
+             pandas would read them as python int / decimal.Decimal objects
+    """
+    selectColumns = []
+    for name, columnType, *_ in connection.execute(f"DESCRIBE {duckdbTable}").fetchall():
+        quotedName = '"' + name.replace('"', '""') + '"'
+        if columnType in ("HUGEINT", "UHUGEINT"):
+            selectColumns.append(f"CAST({quotedName} AS BIGINT) AS {quotedName}")
+        elif columnType.startswith("DECIMAL"):
+            selectColumns.append(f"CAST({quotedName} AS DOUBLE) AS {quotedName}")
+        else:
+            selectColumns.append(quotedName)
+    table = connection.execute(f"SELECT {', '.join(selectColumns)} FROM {duckdbTable}").to_arrow_table()
+    columns = []
+    for column in table.columns:
+        if (pa.types.is_string(column.type) and table.num_rows > 0
+                and pc.count_distinct(column).as_py() <= DICTIONARY_MAX_RATIO * table.num_rows):
+            column = column.dictionary_encode()
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+
+# -------------- duckdbToArrow--------------
+def duckdbToArrow():
+    """
+    writes every exported table as an uncompressed Arrow IPC file in ARROW_DIR, so the dashboard can
+    memory map it without any per row python objects. like the sqlite export, a file is only written
+    again when the content hash of its table changed (the hashes are kept in manifest.json), and it is
+    written to a temp file and swapped in with a rename. the file of a dropped table is removed.
+    :return: the tables that were written or removed
+    """
+    os.makedirs(ARROW_DIR, exist_ok=True)
+    manifestFile = os.path.join(ARROW_DIR, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifestFile):
+        with open(manifestFile) as file:
+            manifest = json.load(file)
+
+    written = []
+    for sqliteTable, duckdbTable in EXPORT_TABLES.items():
+        if sqliteTable in SQL_ONLY_TABLES:
+            continue
+        arrowFile = os.path.join(ARROW_DIR, f"{sqliteTable}.arrow")
+        if not tableExists(duckdbTable):
+            if sqliteTable in manifest:
+                del manifest[sqliteTable]
+                if os.path.exists(arrowFile):
+                    os.remove(arrowFile)
+                written.append(sqliteTable)
+            continue
+        contentHash = tableContentHash(duckdbTable)
+        if manifest.get(sqliteTable) == contentHash and os.path.exists(arrowFile):
+            continue
+        table = arrowTable(duckdbTable)
+        with pa.OSFile(arrowFile + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(arrowFile + ".tmp", arrowFile)
+        manifest[sqliteTable] = contentHash
+        written.append(sqliteTable)
+
+    with open(manifestFile + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(manifestFile + ".tmp", manifestFile)
+    return written
+
+
+# -------------- createExploreDatabase--------------
+def createExploreDatabase(snapshotDir, staged=True):
+    """
+    writes EXPLORE_FILE, the database the Explore and Search pages query, into a new snapshot.
+    the exported tables and the search statistics are small and are copied. JobsStaged, JobsData and
+    SearchPostings are views over the parquet parts hard linked into the snapshot, so publishing does not
+    copy the rows and the views never read a file outside of the snapshot.
+    :param snapshotDir: the directory of the new snapshot, with STAGING_DIR and SEARCH_DIR linked into it
+    :param staged: JobsStaged reads the staged parts, False when it streams the csv files
+    """
+    connection.execute(f"ATTACH '{os.path.join(snapshotDir, EXPLORE_FILE)}' AS Explore")
+    try:
+        for duckdbTable in list(dict.fromkeys(EXPORT_TABLES.values())) + ["SearchWatermark"]:
+            if tableExists(duckdbTable):
+                connection.execute(f"CREATE TABLE Explore.{duckdbTable} AS SELECT * FROM {duckdbTable}")
+
+        files = stagedFiles() if staged else []
+        if files:
+            partitioned = files[0].startswith(PARTITIONED_DIR + os.sep)
+            source = stagedReader(sqlFileList([os.path.join(snapshotDir, file) for file in files]), partitioned)
+            connection.execute(f"CREATE VIEW Explore.JobsStaged AS SELECT * FROM {source}")
+            jobsColumns = ", ".join('"' + name.replace('"', '""') + '"' for (name,) in connection.execute("""
+                SELECT column_name FROM duckdb_columns()
+                WHERE table_name = 'JobsData' AND database_name = current_database()
+                ORDER BY column_index
+            """).fetchall())
+            connection.execute(f"CREATE VIEW Explore.JobsData AS SELECT {jobsColumns} FROM {source}")
+
+        if tableExists("SearchParts") and tableExists("SearchWatermark"):
+            files = [os.path.join(snapshotDir, file) for file in search_index.searchFiles(connection)]
+            connection.execute(f"CREATE VIEW Explore.SearchPostings AS SELECT * FROM {search_index.searchReader(files)}")
+    finally:
+        connection.execute("DETACH Explore")
 
 
 # -------------- saveTablesInDuckDB--------------
-def saveTablesInDuckDB(tableName, query):
+def saveTablesInDuckDB(tableName, query, cursor=None, echo=False, fingerprint=None, profile=None):
     """
     :param tableName: the name of the table we want to create
     :param query: the query that extract the relevant raws and cols from the JobsData table
+    :param cursor: the cursor to run the query on, the shared connection when not given
+    :param echo: print the created table (reads the whole table back into pandas)
+    :param fingerprint: the source data fingerprint, when given the result cache is used
+    :param profile: a dict that gets the DuckDB profile of the query, no profiling when None
+    :return: (the number of rows in the created table, True if it came from the cache)
     """
-    createTable = "CREATE OR REPLACE TABLE " + tableName + " AS "
-    connection.execute(createTable + query)
-    result = connection.execute(f"SELECT * FROM {tableName}").fetchdf()
-    print(result)
+    cursor = cursor or connection
+    if profile is not None:
+        execute = lambda cursor, sql: pipeline_metrics.executeProfiled(cursor, sql, profile)
+    else:
+        execute = lambda cursor, sql: cursor.execute(sql).fetchone()
+    if fingerprint is not None:
+        rows, cached = query_cache.cachedSave(cursor, tableName, query, fingerprint, execute)
+    else:
+        createTable = "CREATE OR REPLACE TABLE " + tableName + " AS "
+        rows, cached = execute(cursor, createTable + query)[0], False
+    if echo:
+        print(cursor.execute(f"SELECT * FROM {tableName}").fetchdf())
+    return rows, cached
 
 
 # -------------- CountryJobs table query--------------
-query1 = """
+# the countries of the top companies table
+LEADING_COUNTRIES = "'Israel', 'USA', 'Japan', 'Germany', 'UK', 'France', 'Italy', 'Canada'"
+
+query1 = f"""
 WITH CompanyJobCount AS (
     SELECT Company, Country, COUNT("Job Id") AS Job_Count
-    FROM JobsData
-    WHERE Country IN ('Israel', 'USA', 'Japan', 'Germany', 'UK', 'France', 'Italy', 'Canada')
+    FROM JobsStaged
+    WHERE Country IN ({LEADING_COUNTRIES})
     GROUP BY Company, Country
 )
 SELECT Company,Country,Job_Count,
-       ROW_NUMBER() OVER (PARTITION BY Country ORDER BY Job_Count DESC) AS Rank,
+       ROW_NUMBER() OVER (PARTITION BY Country ORDER BY Job_Count DESC, Company) AS Rank,
        CAST(SUM(Job_Count) OVER (PARTITION BY Country) AS INTEGER) AS Total_Jobs
 FROM CompanyJobCount
 QUALIFY
@@ -73,27 +807,19 @@ QUALIFY
 ORDER BY Country, Rank
 """
 # -------------- WorkType table query--------------
-query2 = """
-WITH JobsCount AS (
-    SELECT
-        CAST(str_split(Experience, ' to ')[1] AS INT) AS Min_experience,
-        EXTRACT(YEAR FROM "Job Posting Date") AS Year,
-        Qualifications,
-        COUNT(*) AS Filtered_count
-    FROM JobsData
-    GROUP BY year, min_experience, Qualifications
-)
-SELECT Year, Min_experience, Qualifications, Filtered_count AS Job_count
-FROM JobsCount
-WHERE Min_experience IN (0, 1, 2) 
-ORDER BY Year, Qualifications, Min_experience;
+query2 = f"""
+SELECT Year, Min_Experience AS Min_experience, Qualifications, Job_Count AS Job_count
+FROM JobsCube
+WHERE Grouping_Id = {jobs_cube.cubeGroupingId(["Year", "Min_Experience", "Qualifications"])}
+  AND Min_Experience IN (0, 1, 2)
+ORDER BY Year, Qualifications, Min_experience
 """
 
 # -------------- Discrimination table query--------------
-query3 = """
-SELECT Qualifications, Preference, Country, COUNT(*) AS Job_Count
-FROM JobsData
-GROUP BY Qualifications, Preference, Country 
+query3 = f"""
+SELECT Qualifications, Preference, Country, Job_Count
+FROM JobsCube
+WHERE Grouping_Id = {jobs_cube.cubeGroupingId(["Qualifications", "Preference", "Country"])}
 ORDER BY Country, Qualifications, Preference
 """
 
@@ -101,8 +827,8 @@ ORDER BY Country, Qualifications, Preference
 query4 = """
 WITH RecruiterRankings AS (
     SELECT "Job Portal" AS Portal, "Contact Person" AS Contact_Person,
-            ROW_NUMBER() OVER (PARTITION BY Portal ORDER BY COUNT(*) DESC) AS Recruiter_Rank
-    FROM JobsData
+            ROW_NUMBER() OVER (PARTITION BY Portal ORDER BY COUNT(*) DESC, Contact_Person) AS Recruiter_Rank
+    FROM JobsStaged
     GROUP BY Portal, Contact_Person
     QUALIFY
         Recruiter_Rank <= 3
@@ -110,7 +836,7 @@ WITH RecruiterRankings AS (
 PortalRankings AS (
     SELECT "Job Portal" AS Portal, COUNT(*) AS Job_Posts, 
     RANK() OVER (ORDER BY Job_Posts DESC) as Portal_Rank
-    FROM JobsData
+    FROM JobsStaged
     GROUP BY Portal
     QUALIFY
         Portal_Rank <= 5
@@ -125,9 +851,8 @@ ORDER BY Portal_Rank, Recruiter_Rank
 # -------------- UnderMinimum table query--------------
 query5 = """
 WITH SplitSalary AS (
-    SELECT Company,
-           CAST(SPLIT_PART(REPLACE(REPLACE("Salary Range", '$', ''), 'K', ''), '-', 1) AS INTEGER) * 1000 AS Min_Salary
-    FROM JobsData
+    SELECT Company, Min_Salary
+    FROM JobsStaged
 ),
 MarketAverage AS (
     SELECT AVG(Min_Salary) AS Market_Avg_Salary
@@ -141,16 +866,662 @@ GROUP BY s.Company
 ORDER BY Below_Avg DESC
 """
 
-# ----------------------------------------------------
-# Calling the function that create the table from the query
-saveTablesInDuckDB("TopCountriesJobPosts", query1)
-saveTablesInDuckDB("MinimumExperience", query2)
-saveTablesInDuckDB("Discrimination", query3)
-saveTablesInDuckDB("JobMarketRating", query4)
-saveTablesInDuckDB("UnderMinimum", query5)
+# -------------- incremental aggregates--------------
+# the query results are small rank / filter layers over group-by counts, in incremental mode
+# we keep these counts in base tables and only merge the counts of each new ingest batch into them.
+# base table -> the group by columns (with their names in the base table) and the measures, which are
+# merged by summing them. CubeCounts is the cube itself (jobs_cube.py), the cube of a batch is merged
+# into it on the Grouping_Id and the dimensions
+AGGREGATES = {
+    "CompanyCountryCounts": ('Company, Country', {"Job_Count": 'COUNT("Job Id")'}),
+    "PortalRecruiterCounts": ('"Job Portal" AS Portal, "Contact Person" AS Contact_Person', {"Job_Count": 'COUNT(*)'}),
+    "CompanySalaryCounts": ('Company, Min_Salary', {"Job_Count": 'COUNT(*)'}),
+    "CubeCounts": (jobs_cube.CUBE_CELLS, jobs_cube.CUBE_MEASURES),
+}
+
+
+# -------------- partialQuery--------------
+def partialQuery(baseTable, source):
+    """
+    :param baseTable: an AGGREGATES base table
+    :param source: a table (or subquery) with the JobsStaged columns
+    :return: the query of the counts of the base table over the rows of source
+    """
+    groupColumns, measures = AGGREGATES[baseTable]
+    measureColumns = ", ".join(f"{expression} AS {name}" for name, expression in measures.items())
+    query = f"SELECT {groupColumns}, {measureColumns} FROM {source} GROUP BY ALL"
+    # the cube cells are rolled up over the grouping sets of the cube
+    return jobs_cube.cubeQuery(f"({query})") if baseTable == "CubeCounts" else query
+
+
+# -------------- mergeQuery--------------
+def mergeQuery(baseTable, partials):
+    """
+    :param baseTable: an AGGREGATES base table
+    :param partials: a table (or subquery) with the rows of several partial counts of the base table
+    :return: the query that merges the partial counts, by summing the measures of every group.
+             the sums are cast back to BIGINT (SUM of BIGINT is HUGEINT), so the merged tables have the same
+             column types as the tables counted in one pass
+    """
+    measures = AGGREGATES[baseTable][1]
+    sums = ", ".join(f"CAST(SUM({name}) AS BIGINT) AS {name}" for name in measures)
+    return f"""
+        SELECT * EXCLUDE ({", ".join(measures)}), {sums}
+        FROM {partials}
+        GROUP BY ALL
+    """
+
+
+# -------------- mergeStatement--------------
+def mergeStatement(baseTable, batchCounts):
+    """
+    :param baseTable: an AGGREGATES base table
+    :param batchCounts: a subquery of the counts of the base table over the rows of a batch
+    :return: the MERGE that adds the batch counts to the base table in place, the groups are matched on all
+             their columns (a NULL matches a NULL) so only the groups of the batch are written
+    """
+    measures = AGGREGATES[baseTable][1]
+    groupColumns = [name for name, *_ in connection.execute(f"DESCRIBE {baseTable}").fetchall() if name not in measures]
+    matches = " AND ".join(f'{baseTable}."{name}" IS NOT DISTINCT FROM Batch."{name}"' for name in groupColumns)
+    sums = ", ".join(f"{name} = {baseTable}.{name} + Batch.{name}" for name in measures)
+    return f"""
+        MERGE INTO {baseTable}
+        USING {batchCounts} AS Batch
+        ON {matches}
+        WHEN MATCHED THEN UPDATE SET {sums}
+        WHEN NOT MATCHED THEN INSERT BY NAME
+    """
+
+
+# -------------- refreshAggregates--------------
+def refreshAggregates():
+    """
+    this function brings the AGGREGATES base tables up to date with JobsData.
+    the number of JobsData rows the base tables count is kept in AggregateWatermark, when the
+    base tables are exactly one ingest batch behind only the IngestBatch counts are merged,
+    otherwise (first run, or a run that stopped in the middle) they are rebuilt from JobsStaged.
+    :return: True if the batch was merged, False if the base tables were rebuilt
+    """
+    connection.execute("CREATE TABLE IF NOT EXISTS AggregateWatermark (Rows_Counted BIGINT)")
+    rowsCounted = connection.execute("SELECT MAX(Rows_Counted) FROM AggregateWatermark").fetchone()[0]
+    batch, totalRows = lastBatch()
+    batchRows = connection.execute(f"SELECT COUNT(*) FROM {batch}").fetchone()[0] if batch else 0
+    # a base table that is missing (or was renamed by a newer version) is rebuilt with all the others
+    baseTables = connection.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE list_contains(?, table_name)", [list(AGGREGATES)]
+    ).fetchone()[0]
+    merge = rowsCounted is not None and rowsCounted + batchRows == totalRows and baseTables == len(AGGREGATES)
+
+    connection.execute("BEGIN TRANSACTION")
+    for baseTable in AGGREGATES:
+        if not merge:
+            connection.execute(f"CREATE OR REPLACE TABLE {baseTable} AS {partialQuery(baseTable, 'JobsStaged')}")
+        elif batchRows > 0:
+            batchCounts = partialQuery(baseTable, f"({stagedSelect('IngestBatch', True)})")
+            connection.execute(mergeStatement(baseTable, f"({batchCounts})"))
+    connection.execute("DELETE FROM AggregateWatermark")
+    connection.execute("INSERT INTO AggregateWatermark VALUES (?)", [totalRows])
+    connection.execute("COMMIT")
+    return merge
+
+
+# the queries of the result tables over the base tables
+incrementalQuery1 = f"""
+SELECT Company, Country, Job_Count,
+       ROW_NUMBER() OVER (PARTITION BY Country ORDER BY Job_Count DESC, Company) AS Rank,
+       CAST(SUM(Job_Count) OVER (PARTITION BY Country) AS INTEGER) AS Total_Jobs
+FROM CompanyCountryCounts
+WHERE Country IN ({LEADING_COUNTRIES})
+QUALIFY
+    Rank <= 5
+ORDER BY Country, Rank
+"""
+
+incrementalQuery4 = """
+WITH RecruiterRankings AS (
+    SELECT Portal, Contact_Person,
+           ROW_NUMBER() OVER (PARTITION BY Portal ORDER BY Job_Count DESC, Contact_Person) AS Recruiter_Rank
+    FROM PortalRecruiterCounts
+    QUALIFY
+        Recruiter_Rank <= 3
+),
+PortalRankings AS (
+    SELECT Portal, CAST(SUM(Job_Count) AS BIGINT) AS Job_Posts,
+           RANK() OVER (ORDER BY Job_Posts DESC) AS Portal_Rank
+    FROM PortalRecruiterCounts
+    GROUP BY Portal
+    QUALIFY
+        Portal_Rank <= 5
+)
+SELECT Portal, Job_Posts, Portal_Rank, Contact_Person, Recruiter_Rank
+FROM PortalRankings
+JOIN RecruiterRankings
+USING (Portal)
+ORDER BY Portal_Rank, Recruiter_Rank
+"""
+
+incrementalQuery5 = """
+WITH MarketAverage AS (
+    SELECT CAST(SUM(Min_Salary * Job_Count) AS DOUBLE) / SUM(Job_Count) FILTER (WHERE Min_Salary IS NOT NULL)
+           AS Market_Avg_Salary
+    FROM CompanySalaryCounts
+)
+SELECT s.Company, CAST(SUM(s.Job_Count) AS BIGINT) AS Below_Avg
+FROM CompanySalaryCounts s
+CROSS JOIN MarketAverage m
+WHERE s.Min_Salary < m.Market_Avg_Salary
+GROUP BY s.Company
+ORDER BY Below_Avg DESC
+"""
+
+# -------------- query registry--------------
+# result table -> (query, the result tables the query reads)
+# the queries read JobsStaged and can run at the same time, the cube slices wait for JobsCube
+QUERIES = {
+    "JobsCube": (partialQuery("CubeCounts", "JobsStaged"), []),
+    "TopCountriesJobPosts": (query1, []),
+    "MinimumExperience": (query2, ["JobsCube"]),
+    "Discrimination": (query3, ["JobsCube"]),
+    "JobMarketRating": (query4, []),
+    "UnderMinimum": (query5, []),
+}
+
+# the same result tables from the AGGREGATES base tables, refreshAggregates() has to run first
+INCREMENTAL_QUERIES = {
+    "JobsCube": ("SELECT * FROM CubeCounts", []),
+    "TopCountriesJobPosts": (incrementalQuery1, []),
+    "MinimumExperience": (query2, ["JobsCube"]),
+    "Discrimination": (query3, ["JobsCube"]),
+    "JobMarketRating": (incrementalQuery4, []),
+    "UnderMinimum": (incrementalQuery5, []),
+}
+
+# -------------- sharded execution--------------
+# the map-reduce mode: worker processes count the AGGREGATES of disjoint shards of the input (csv files or
+# row group ranges of the staged parquet parts), the reducer sums the partial counts into the base tables and
+# the rank and QUALIFY layers of INCREMENTAL_QUERIES run on the merged counts, so the results are the same as
+# in a single process
+SHARD_DIR = "shards"
+
+
+# -------------- splitShards--------------
+def splitShards(files, shards, parquet=False):
+    """
+    :param files: the input files
+    :param shards: the number of shards
+    :param parquet: the files are parquet files, they are split at their row groups so a large part (the first
+                    part stages all of JobsData) is divided between the shards too. csv files are split whole
+    :return: at most shards non empty lists of (file, first row, end row) ranges with about the same number
+             of bytes, the rows are None for a whole file
+    """
+    if not parquet:
+        groups = [[] for _ in range(min(shards, len(files)))]
+        sizes = [0] * len(groups)
+        for file in sorted(files, key=os.path.getsize, reverse=True):
+            smallest = sizes.index(min(sizes))
+            groups[smallest].append((file, None, None))
+            sizes[smallest] += os.path.getsize(file)
+        return groups
+
+    rowGroups = []
+    for file in files:
+        rowGroups.extend((file, rows, size) for rows, size in connection.execute(f"""
+            SELECT ANY_VALUE(row_group_num_rows), ANY_VALUE(row_group_bytes)
+            FROM parquet_metadata({sqlFileList([file])})
+            GROUP BY row_group_id
+            ORDER BY row_group_id
+        """).fetchall())
+    # the row groups in file order are cut into contiguous ranges, a shard reads at most two files in part
+    totalBytes = max(sum(size for _, _, size in rowGroups), 1)
+    groups = [[] for _ in range(min(shards, len(rowGroups)))]
+    fileRows = {}
+    position = 0
+    for file, rows, size in rowGroups:
+        group = groups[min(int((position + size / 2) * len(groups) / totalBytes), len(groups) - 1)]
+        firstRow = fileRows.get(file, 0)
+        if group and group[-1][0] == file and group[-1][2] == firstRow:
+            group[-1] = (file, group[-1][1], firstRow + rows)
+        else:
+            group.append((file, firstRow, firstRow + rows))
+        fileRows[file] = firstRow + rows
+        position += size
+    return [[(file, None, None) if firstRow == 0 and endRow == fileRows[file] else (file, firstRow, endRow)
+             for file, firstRow, endRow in group] for group in groups if group]
+
+
+# -------------- shardSource--------------
+def shardSource(ranges, streaming=False, partitioned=False):
+    """
+    :param ranges: the (file, first row, end row) ranges of a shard (splitShards)
+    :param streaming: the files are csv files, otherwise they are staged parquet parts
+    :param partitioned: the staged parts are in the hive partitioned layout
+    :return: the query of the rows of the shard, with the JobsStaged columns. a row range only reads its
+             row groups, the file_row_number filter is checked against the row group offsets
+    """
+    if streaming:
+        return stagedSelect(csvReader([file for file, _, _ in ranges]), True)
+    wholeFiles = [file for file, firstRow, _ in ranges if firstRow is None]
+    selects = [f"SELECT * FROM {stagedReader(sqlFileList(wholeFiles), partitioned)}"] if wholeFiles else []
+    for file, firstRow, endRow in ranges:
+        if firstRow is not None:
+            selects.append(f"""
+                SELECT * EXCLUDE (file_row_number)
+                FROM {stagedReader(sqlFileList([file]), partitioned, True)}
+                WHERE file_row_number >= {firstRow} AND file_row_number < {endRow}
+            """)
+    return " UNION ALL BY NAME ".join(selects)
+
+
+# -------------- mapShard--------------
+def mapShard(shardNumber, source, outputDir, config=None):
+    """
+    the map step, it runs in a worker process. the AGGREGATES of the rows of one shard are counted and every
+    partial count is written to outputDir/<base table>/shard-<shardNumber>.parquet. only the input files and
+    the output directory are needed, so a worker can run on any machine that shares them.
+    :param shardNumber: the number of the shard
+    :param source: the query of the rows of the shard (shardSource)
+    :param outputDir: the directory of the partial counts
+    :param config: the DuckDB configuration of the worker
+    """
+    config = dict(config or {})
+    if "temp_directory" in config:
+        # the workers must not spill into the same files
+        config["temp_directory"] = os.path.join(config["temp_directory"], f"shard-{shardNumber:05d}")
+    worker = duckdb.connect(config=config)
+    try:
+        for baseTable in AGGREGATES:
+            os.makedirs(os.path.join(outputDir, baseTable), exist_ok=True)
+            partialFile = os.path.join(outputDir, baseTable, f"shard-{shardNumber:05d}.parquet")
+            worker.execute(f"COPY ({partialQuery(baseTable, f'({source})')}) TO '{partialFile}' (FORMAT PARQUET)")
+    finally:
+        worker.close()
+
+
+# -------------- mapShards--------------
+def mapShards(sources, workers, config=None):
+    """
+    runs mapShard for every shard on a pool of worker processes, the partial counts of an earlier run are removed
+    :param sources: the query of the rows of every shard
+    :param workers: the number of worker processes
+    :param config: the DuckDB configuration of every worker
+    :return: the number of shards
+    """
+    shutil.rmtree(SHARD_DIR, ignore_errors=True)
+    # the workers are spawned, a forked worker would inherit the threads and the open database of this process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(mapShard, shardNumber, source, SHARD_DIR, config)
+                   for shardNumber, source in enumerate(sources)]
+        for future in futures:
+            future.result()
+    return len(sources)
+
+
+# -------------- reduceShards--------------
+def reduceShards(rowsCounted=None):
+    """
+    the reduce step: merges the partial counts of all the shards into the AGGREGATES base tables
+    :param rowsCounted: the number of JobsData rows the shards counted. it is recorded in AggregateWatermark, so an
+                        --incremental run merges its batch into the base tables. None when the shards were csv
+                        files that are not in JobsData, the next --incremental run then rebuilds them
+    """
+    connection.execute("CREATE TABLE IF NOT EXISTS AggregateWatermark (Rows_Counted BIGINT)")
+    connection.execute("BEGIN TRANSACTION")
+    for baseTable in AGGREGATES:
+        partials = f"read_parquet('{os.path.join(SHARD_DIR, baseTable, '*.parquet')}')"
+        connection.execute(f"CREATE OR REPLACE TABLE {baseTable} AS {mergeQuery(baseTable, partials)}")
+    connection.execute("DELETE FROM AggregateWatermark")
+    if rowsCounted is not None:
+        connection.execute("INSERT INTO AggregateWatermark VALUES (?)", [rowsCounted])
+    connection.execute("COMMIT")
+
+# -------------- approximate queries--------------
+# the exploration variants of the slow group-bys. they run on a row sample of JobsStaged and with sketches,
+# and every estimated count comes with rough error bounds (_Low and _High columns)
+APPROXIMATE_PERCENT = 5
+APPROXIMATE_SEED = 42
+
+
+# -------------- sampledRows--------------
+def sampledRows(columns, percent, seed, totalRows=None):
+    """
+    the rows are sampled one by one (BERNOULLI). a block sample (SYSTEM) reads less, but the staged rows are
+    often ordered by a group by column (the partitioned layout, a csv sorted by country) and then whole groups
+    fall in or out of the sample together, the binomial error of estimateColumns would be far too small
+    :param columns: the columns of JobsStaged the query needs
+    :param totalRows: the number of rows of JobsStaged, None when it is not known without a scan (streamed csv),
+                      the sampled fraction is then taken to be the nominal percent
+    :return: the Sampled and Fraction common table expressions, the count of a group is estimated
+             as its count in Sampled / Sampled_Fraction
+    """
+    if totalRows is None:
+        fraction = f"{percent} / 100"
+    else:
+        fraction = f"(SELECT COUNT(*) FROM Sampled) / GREATEST({int(totalRows)}, 1)"
+    return f"""
+    Sampled AS MATERIALIZED (
+        SELECT {columns} FROM JobsStaged TABLESAMPLE BERNOULLI ({percent} PERCENT) REPEATABLE ({seed})
+    ),
+    Fraction AS (
+        SELECT {fraction} AS Sampled_Fraction
+    )"""
+
+
+# -------------- estimateColumns--------------
+def estimateColumns(sampleCount, name):
+    """
+    :param sampleCount: the sql of the number of sampled rows of a group
+    :param name: the name of the estimated count
+    :return: the sql of the estimated count and of its error bounds, two standard errors of the binomial
+             sampling error of a row sample on either side (a group has at least the rows that were sampled).
+             they are a rough guide for exploration, not intervals with a guaranteed coverage
+    """
+    estimate = f"{sampleCount} / Sampled_Fraction"
+    error = f"2 * SQRT({sampleCount} * (1 - Sampled_Fraction)) / Sampled_Fraction"
+    return f"""CAST(ROUND({estimate}) AS BIGINT) AS {name},
+               CAST(GREATEST({sampleCount}, ROUND({estimate} - {error})) AS BIGINT) AS {name}_Low,
+               CAST(ROUND({estimate} + {error}) AS BIGINT) AS {name}_High"""
+
+
+# -------------- approximateQueries--------------
+def approximateQueries(percent=APPROXIMATE_PERCENT, seed=APPROXIMATE_SEED, totalRows=None):
+    """
+    :param percent: the sampled percent of the rows
+    :param seed: the sample seed, the same seed gives the same results
+    :param totalRows: the number of rows of JobsStaged (see sampledRows)
+    :return: the registry of the approximate result tables, with the columns of the exact tables plus the bounds
+    """
+    # the top companies of a country are found with the approx_top_k (space saving) sketch over the sample.
+    # distinct counts cannot be scaled up from a sample, the companies of a country are estimated with the
+    # (bias corrected) Chao1 estimator: the companies that were never sampled are estimated from the number
+    # of companies sampled once (F1) and twice (F2), as F1 * (F1 - 1) / (2 * (F2 + 1))
+    approximateQuery1 = f"""
+    WITH {sampledRows("Company, Country", percent, seed, totalRows)},
+    CountryRows AS (
+        SELECT Country, COUNT(*) AS Sampled_Jobs, approx_top_k(Company, 5) AS Top_Companies
+        FROM Sampled
+        WHERE Country IN ({LEADING_COUNTRIES})
+        GROUP BY Country
+    ),
+    CompanyFrequencies AS (
+        SELECT Country, Company, COUNT(*) AS Sampled_Count
+        FROM Sampled
+        WHERE Country IN ({LEADING_COUNTRIES})
+        GROUP BY Country, Company
+    ),
+    CompanyRows AS (
+        SELECT Country, Company, Sampled_Count
+        FROM CompanyFrequencies
+        JOIN (SELECT Country, UNNEST(Top_Companies) AS Company FROM CountryRows) USING (Country, Company)
+    ),
+    CountryCompanies AS (
+        SELECT Country,
+               CAST(ROUND(COUNT(*) + COUNT(*) FILTER (Sampled_Count = 1) * (COUNT(*) FILTER (Sampled_Count = 1) - 1)
+                                     / (2 * (COUNT(*) FILTER (Sampled_Count = 2) + 1))) AS BIGINT) AS Companies
+        FROM CompanyFrequencies
+        GROUP BY Country
+    )
+    SELECT Company, Country, {estimateColumns("Sampled_Count", "Job_Count")},
+           ROW_NUMBER() OVER (PARTITION BY Country ORDER BY Sampled_Count DESC, Company) AS Rank,
+           {estimateColumns("Sampled_Jobs", "Total_Jobs")},
+           Companies
+    FROM CompanyRows
+    JOIN CountryRows USING (Country)
+    JOIN CountryCompanies USING (Country)
+    CROSS JOIN Fraction
+    ORDER BY Country, Rank
+    """
+
+    approximateQuery3 = f"""
+    WITH {sampledRows("Qualifications, Preference, Country", percent, seed, totalRows)}
+    SELECT Qualifications, Preference, Country, {estimateColumns("COUNT(*)", "Job_Count")}
+    FROM Sampled
+    CROSS JOIN Fraction
+    GROUP BY Qualifications, Preference, Country, Sampled_Fraction
+    ORDER BY Country, Qualifications, Preference
+    """
+
+    # the top recruiters of a portal are found with the approx_top_k sketch over the sample
+    approximateQuery4 = f"""
+    WITH {sampledRows('"Job Portal" AS Portal, "Contact Person" AS Contact_Person', percent, seed, totalRows)},
+    PortalRankings AS (
+        SELECT Portal, COUNT(*) AS Sampled_Posts, approx_top_k(Contact_Person, 3) AS Top_Recruiters,
+               RANK() OVER (ORDER BY COUNT(*) DESC) AS Portal_Rank
+        FROM Sampled
+        GROUP BY Portal
+        QUALIFY
+            Portal_Rank <= 5
+    )
+    SELECT Portal, {estimateColumns("Sampled_Posts", "Job_Posts")}, Portal_Rank,
+           UNNEST(Top_Recruiters) AS Contact_Person, UNNEST(range(1, len(Top_Recruiters) + 1)) AS Recruiter_Rank
+    FROM PortalRankings
+    CROSS JOIN Fraction
+    ORDER BY Portal_Rank, Recruiter_Rank
+    """
+
+    return {
+        "TopCountriesJobPostsApprox": (approximateQuery1, []),
+        "DiscriminationApprox": (approximateQuery3, []),
+        "JobMarketRatingApprox": (approximateQuery4, []),
+    }
+
+
+# -------------- dropApproximateTables--------------
+def dropApproximateTables():
+    """
+    drops the approximate result tables. they estimate the rows of the run that created them, after a run
+    that is not approximate they are stale, and the exports remove them as well
+    :return: the tables that were dropped
+    """
+    dropped = [tableName for tableName in approximateQueries() if tableExists(tableName)]
+    for tableName in dropped:
+        connection.execute(f"DROP TABLE {tableName}")
+    return dropped
+
+
+# -------------- runQueries--------------
+def runQueries(tableNames=None, echo=False, workers=4, queries=QUERIES, fingerprint=None, run=None):
+    """
+    this function creates the result tables of the registry.
+    a query starts as soon as the tables it reads are ready, independent queries run
+    concurrently, each one on its own cursor of the connection.
+    :param tableNames: the result tables to create together with the tables they read, all the registered tables
+                       when None
+    :param echo: print every created table
+    :param workers: the maximum number of queries that run at the same time
+    :param queries: the registry to run (QUERIES or INCREMENTAL_QUERIES)
+    :param fingerprint: the source data fingerprint for the result cache, no caching when None
+    :param run: the pipeline_metrics run, when given every query is profiled and recorded in PipelineMetrics
+    :return: dict of table name -> (wall time in seconds, number of rows)
+    """
+    tableNames = list(queries) if tableNames is None else tableNames
+    unknown = [tableName for tableName in tableNames if tableName not in queries]
+    if unknown:
+        raise ValueError(f"unknown result tables: {', '.join(unknown)}")
+
+    # the tables a query reads are always recreated in the same run, so a dependent table never reads a result
+    # of older data. the dependencies come before the tables that read them.
+    runTables = []
+
+    def addTable(tableName):
+        if tableName in runTables:
+            return
+        for dependency in queries[tableName][1]:
+            addTable(dependency)
+        runTables.append(tableName)
+
+    for tableName in tableNames:
+        addTable(tableName)
+
+    # the cache key of a table covers the cache keys of the tables it reads, a cached result is only restored
+    # when the whole chain of queries is unchanged
+    fingerprints = {}
+    if fingerprint is not None:
+        for tableName in runTables:
+            fingerprints[tableName] = "\n".join(
+                [fingerprint] + [query_cache.cacheKey(queries[dependency][0], fingerprints[dependency])
+                                 for dependency in queries[tableName][1]])
+
+    def runOne(tableName):
+        start = time.perf_counter()
+        cursor = connection.cursor()
+        profile = {} if run is not None else None
+        try:
+            rows, cached = saveTablesInDuckDB(tableName, queries[tableName][0], cursor, echo,
+                                              fingerprints.get(tableName), profile)
+        finally:
+            cursor.close()
+        return tableName, time.perf_counter() - start, rows, cached, profile
+
+    pending = dict((tableName, set(queries[tableName][1])) for tableName in runTables)
+    report = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = set()
+        while pending or running:
+            ready = [tableName for tableName, dependencies in pending.items() if not dependencies]
+            for tableName in ready:
+                del pending[tableName]
+                running.add(executor.submit(runOne, tableName))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tableName, seconds, rows, cached, profile = future.result()
+                report[tableName] = (seconds, rows)
+                print(f"{tableName}: {rows} rows in {seconds:.3f}s{' (cached)' if cached else ''}")
+                if run is not None:
+                    pipeline_metrics.recordStep(connection, run, f"query {tableName}", seconds, rowsOut=rows,
+                                                cached=cached, profile=profile)
+                for dependencies in pending.values():
+                    dependencies.discard(tableName)
+    return report
+
+
+# -------------- main--------------
+def main():
+    """
+    loads the new csv rows, runs the queries and copies the small tables into sqlite
+    """
+    parser = argparse.ArgumentParser(description="load the jobs data set into duckdb and run the queries")
+    parser.add_argument("--tables", nargs="+", choices=list(QUERIES) + list(approximateQueries()),
+                        help="only create these result tables and the tables they read")
+    parser.add_argument("--echo", action="store_true", help="print every result table")
+    parser.add_argument("--workers", type=int,
+                        help="number of queries that run at the same time (default 4, 1 with --memory-limit)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="merge the new batch into the base count tables instead of scanning all of JobsData")
+    parser.add_argument("--sharded", nargs="?", type=int, const=os.cpu_count() or 1, metavar="WORKERS",
+                        help="map-reduce: count the base tables of the input shards on this many worker processes "
+                             "(default: one per core), merge them and rank the merged counts")
+    parser.add_argument("--approximate", nargs="?", type=float, const=APPROXIMATE_PERCENT, metavar="PERCENT",
+                        help="create the approximate result tables (*Approx) from a sample of this percent "
+                             f"of the rows (default {APPROXIMATE_PERCENT}), with error bounds")
+    parser.add_argument("--no-search-index", action="store_true",
+                        help="do not update the full text index, the next run that does rebuilds it")
+    parser.add_argument("--no-cache", action="store_true", help="always execute the queries")
+    parser.add_argument("--clear-cache", action="store_true", help="invalidate all the cached query results first")
+    parser.add_argument("--source", default=CSV_SOURCE, help="csv file or glob of csv shards, e.g. 'feed/*.csv'")
+    parser.add_argument("--streaming", action="store_true",
+                        help="query the csv files directly instead of loading them into JobsData")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="stage the data hive partitioned by Country and posting year")
+    parser.add_argument("--memory-limit", help="DuckDB memory limit, e.g. 4GB, larger operators spill to disk")
+    parser.add_argument("--threads", type=int, help="DuckDB worker threads")
+    parser.add_argument("--temp-dir", help="directory for the spilled data")
+    parser.add_argument("--no-insertion-order", action="store_true",
+                        help="do not preserve the insertion order, uses less memory")
+    args = parser.parse_args()
+    if args.streaming and args.incremental:
+        parser.error("--incremental needs the ingest batches, it cannot be used with --streaming")
+    if args.streaming and args.partitioned:
+        parser.error("--partitioned stages the data, it cannot be used with --streaming")
+    if args.approximate is not None and args.incremental:
+        parser.error("--approximate samples JobsStaged, it cannot be used with --incremental")
+    if args.sharded is not None and (args.incremental or args.approximate is not None):
+        parser.error("--sharded cannot be used with --incremental or --approximate")
+    if args.workers is None:
+        # the concurrent queries share the memory limit, under a tight limit they run one at a time
+        args.workers = 1 if args.memory_limit else 4
+
+    openDatabase(config=executionConfig(args.memory_limit, args.threads, args.temp_dir, not args.no_insertion_order))
+    pipeline_metrics.createMetricsTable(connection)
+    run = pipeline_metrics.newRun()
+    if args.streaming:
+        sourceFiles = pipeline_metrics.timedStep(connection, run, "staging", lambda: streamCsv(args.source))
+        sampleSource = "(SELECT * EXCLUDE (Min_Experience, Max_Experience, Min_Salary, Max_Salary) FROM JobsStaged)"
+    else:
+        newRows = pipeline_metrics.timedStep(connection, run, "ingest",
+                                             lambda: ingestCsv(args.source, args.partitioned),
+                                             rowsOut=lambda rows: rows)
+        print(f"loaded {newRows} new rows into JobsData")
+        pipeline_metrics.timedStep(connection, run, "staging", lambda: refreshStaging(args.partitioned))
+        if args.partitioned:
+            compacted = pipeline_metrics.timedStep(connection, run, "compaction", compactPartitions,
+                                                   rowsOut=lambda partitions: partitions)
+            print(f"compacted the small files of {compacted} partitions")
+        sampleSource = "JobsData"
+    merged = pipeline_metrics.timedStep(connection, run, "sampling", lambda: createSampleTable(sampleSource))
+    print(f"samples: {len(merged)} merged, {len(sampling.SAMPLES) - len(merged)} resampled")
+    if not args.streaming and not args.no_search_index:
+        # the streaming source would have to be indexed again on every run, it is not searchable
+        appended = pipeline_metrics.timedStep(connection, run, "search index", createSearchIndex)
+        print(f"search index {'updated' if appended else 'rebuilt'}")
+
+    query_cache.createCacheTables(connection)
+    if args.clear_cache:
+        print(f"invalidated {query_cache.invalidateCache(connection)} cached results")
+    fingerprint = None
+    if not args.no_cache:
+        if not args.streaming:
+            sourceFiles = stagedFiles()
+        fingerprint = query_cache.sourceFingerprint(connection, sourceFiles)
+
+    start = time.perf_counter()
+    if args.incremental:
+        merged = pipeline_metrics.timedStep(connection, run, "aggregates", refreshAggregates)
+        print(f"base count tables {'merged' if merged else 'rebuilt'} in {time.perf_counter() - start:.3f}s")
+        runQueries(args.tables, args.echo, args.workers, INCREMENTAL_QUERIES, fingerprint, run)
+    elif args.sharded is not None:
+        shardFiles = sorted(glob.glob(args.source)) if args.streaming else stagedFiles()
+        sources = [shardSource(ranges, args.streaming, args.partitioned)
+                   for ranges in splitShards(shardFiles, args.sharded, not args.streaming)]
+        # the cores are divided between the workers, the memory limit is per worker
+        workerThreads = args.threads or max(1, (os.cpu_count() or 1) // args.sharded)
+        workerConfig = executionConfig(args.memory_limit, workerThreads, args.temp_dir, not args.no_insertion_order)
+        shards = pipeline_metrics.timedStep(connection, run, "map",
+                                            lambda: mapShards(sources, args.sharded, workerConfig),
+                                            rowsOut=lambda shards: shards)
+        rowsCounted = None if args.streaming else connection.execute("SELECT COUNT(*) FROM JobsData").fetchone()[0]
+        pipeline_metrics.timedStep(connection, run, "reduce", lambda: reduceShards(rowsCounted))
+        print(f"{shards} shards mapped and reduced in {time.perf_counter() - start:.3f}s")
+        runQueries(args.tables, args.echo, args.workers, INCREMENTAL_QUERIES, fingerprint, run)
+    elif args.approximate is not None:
+        # the streamed csv has no row count, the estimates use the nominal percent
+        totalRows = None if args.streaming else stagedRowCount()
+        runQueries(args.tables, args.echo, args.workers,
+                   approximateQueries(args.approximate, APPROXIMATE_SEED, totalRows), fingerprint, run)
+    else:
+        runQueries(args.tables, args.echo, args.workers, QUERIES, fingerprint, run)
+    if args.approximate is None:
+        dropped = dropApproximateTables()
+        if dropped:
+            print(f"dropped the stale approximate tables: {', '.join(dropped)}")
+    print(f"queries finished in {time.perf_counter() - start:.3f}s")
+    query_cache.evictCache(connection)
+
+    # the arrow files are written first, the dashboard caches are keyed on the version of the sqlite file.
+    # the metrics of the export itself reach the exported files with the next export
+    written = pipeline_metrics.timedStep(connection, run, "arrow export", duckdbToArrow,
+                                         rowsOut=lambda tables: len(tables))
+    print(f"exported to arrow: {', '.join(written) if written else 'nothing changed'}")
+    exported = pipeline_metrics.timedStep(connection, run, "sqlite export", duckdbToSqlite,
+                                          rowsOut=lambda tables: len(tables))
+    print(f"exported to sqlite: {', '.join(exported) if exported else 'nothing changed'}")
+
+    # the dashboard reads only the published snapshots, never the working databases
+    start = time.perf_counter()
+    version = snapshots.publishSnapshot([SQLITE_FILE, ARROW_DIR, STAGING_DIR, search_index.SEARCH_DIR],
+                                        lambda snapshotDir: createExploreDatabase(snapshotDir, not args.streaming))
+    print(f"published snapshot {version} in {time.perf_counter() - start:.3f}s")
+    connection.close()
 
-# only if we did not load the tables to Sqlite yet
-if not os.path.exists("db_file.sqlite"):
-    duckdbToSqlite()
 
-connection.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+The definition of JobsCube, shared by the pipeline that computes it (duckdb_sqlite.py) and the dashboard
+that slices it (dashboard_data.py). The Grouping_Id of a grouping set depends on the order of CUBE_DIMENSIONS,
+so both sides must read it from here.
+"""
+
+# the counts and salary sums of combinations of these dimensions, computed once with GROUPING SETS.
+# the slices of the result tables and of the dashboard filters are read from it instead of scanning JobsData
+CUBE_DIMENSIONS = ("Country", "Qualifications", "Preference", "Year", "Min_Experience", "Portal")
+
+# the grouping sets kept in JobsCube: the finest one, that every other slice can be rolled up from, the slices
+# of the result tables and of the dashboard pages, every single dimension (the filter options) and the grand total.
+# the full CUBE of the six dimensions is larger than JobsData itself
+CUBE_GROUPING_SETS = (
+    CUBE_DIMENSIONS,
+    ("Country", "Qualifications", "Preference"),
+    ("Qualifications", "Year", "Min_Experience"),
+) + tuple((dimension,) for dimension in CUBE_DIMENSIONS) + ((),)
+
+# the finest grouping of the cube and its measures, all of them are sums so cells can be merged and rolled up
+CUBE_CELLS = 'Country, Qualifications, Preference, EXTRACT(YEAR FROM "Job Posting Date") AS Year, ' \
+             'Min_Experience, "Job Portal" AS Portal'
+CUBE_MEASURES = {
+    "Job_Count": "COUNT(*)",
+    "Salary_Count": "COUNT(Min_Salary)",
+    "Min_Salary_Sum": "SUM(Min_Salary)",
+    "Max_Salary_Sum": "SUM(Max_Salary)",
+}
+
+
+# -------------- cubeGroupingId--------------
+def cubeGroupingId(columns):
+    """
+    :param columns: the dimensions of a grouping set of the cube
+    :return: the Grouping_Id of the set in JobsCube, a bit per dimension that is set when the dimension is rolled up
+    """
+    return sum(1 << (len(CUBE_DIMENSIONS) - 1 - position)
+               for position, dimension in enumerate(CUBE_DIMENSIONS) if dimension not in columns)
+
+
+# -------------- cubeGroupingSet--------------
+def cubeGroupingSet(columns):
+    """
+    :param columns: the dimensions a slice groups or filters by
+    :return: the smallest grouping set of CUBE_GROUPING_SETS with all the columns, the slice sums its rows
+    """
+    return min((groupingSet for groupingSet in CUBE_GROUPING_SETS if set(columns) <= set(groupingSet)), key=len)
+
+
+# -------------- cubeQuery--------------
+def cubeQuery(cells):
+    """
+    :param cells: a table (or subquery) of the cube cells - the CUBE_CELLS groups with the CUBE_MEASURES
+    :return: the query of JobsCube, the cells rolled up over the CUBE_GROUPING_SETS
+    """
+    dimensions = ", ".join(CUBE_DIMENSIONS)
+    measures = ", ".join(f"CAST(SUM({name}) AS BIGINT) AS {name}" for name in CUBE_MEASURES)
+    groupingSets = ", ".join("(" + ", ".join(groupingSet) + ")" for groupingSet in CUBE_GROUPING_SETS)
+    return f"""
+SELECT GROUPING({dimensions}) AS Grouping_Id, {dimensions}, {measures}
+FROM {cells}
+GROUP BY GROUPING SETS ({groupingSets})
+"""
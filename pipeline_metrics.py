@@ -0,0 +1,142 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+Profiling of the pipeline steps.
+Every step of a run is appended to the PipelineMetrics table with its wall time, rows in
+and out, peak memory and, for the sql steps, the DuckDB profile (the json form of
+EXPLAIN ANALYZE), so slow runs can be traced to the step that caused them.
+"""
+
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, the peak memory of the python steps is not recorded there
+    resource = None
+
+# the directory of the DuckDB profile files of the running steps
+PROFILE_DIR = tempfile.gettempdir()
+
+
+# -------------- createMetricsTable--------------
+def createMetricsTable(connection):
+    """
+    creates the run history table of the step metrics
+    """
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS PipelineMetrics (
+            Run_Id VARCHAR,
+            Run_Started TIMESTAMP,
+            Step VARCHAR,
+            Wall_Seconds DOUBLE,
+            Rows_In BIGINT,
+            Rows_Out BIGINT,
+            Peak_Memory_MB DOUBLE,
+            Cached BOOLEAN,
+            Profile VARCHAR
+        )
+    """)
+
+
+# -------------- newRun--------------
+def newRun():
+    """
+    :return: (run id, run start time) of a new pipeline run
+    """
+    started = datetime.datetime.now()
+    return started.strftime("%Y%m%d-%H%M%S-") + f"{os.getpid()}", started
+
+
+# -------------- processPeakMemoryMb--------------
+def processPeakMemoryMb():
+    """
+    :return: the peak resident memory of the process so far in MB, None where it is not available
+    """
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, linux kilobytes
+    return maxRss / 2 ** 20 if sys.platform == "darwin" else maxRss / 1024
+
+
+# -------------- executeProfiled--------------
+def executeProfiled(cursor, sql, profile):
+    """
+    executes sql with DuckDB profiling enabled on the cursor only
+    :param cursor: the cursor of the step
+    :param sql: the statement
+    :param profile: a dict that gets the parsed json profile of the statement
+    :return: the first row of the result
+    """
+    profileFile = os.path.join(PROFILE_DIR, f"duckdb-profile-{os.getpid()}-{id(cursor)}.json")
+    cursor.execute("PRAGMA enable_profiling = 'json'")
+    cursor.execute(f"PRAGMA profiling_output = '{profileFile}'")
+    try:
+        result = cursor.execute(sql).fetchone()
+    finally:
+        cursor.execute("PRAGMA disable_profiling")
+    try:
+        with open(profileFile) as file:
+            profile.update(json.load(file))
+        os.remove(profileFile)
+    except (OSError, ValueError):
+        pass
+    return result
+
+
+# -------------- profileRowsIn--------------
+def profileRowsIn(profile):
+    """
+    :param profile: a DuckDB json profile
+    :return: the number of rows the scans at the leaves of the plan produced
+    """
+    def leaves(node):
+        children = node.get("children", [])
+        if not children:
+            return node.get("operator_cardinality", 0) if "operator_type" in node else 0
+        return sum(leaves(child) for child in children)
+    return leaves(profile) if profile else None
+
+
+# -------------- recordStep--------------
+def recordStep(connection, run, step, seconds, rowsIn=None, rowsOut=None, peakMemoryMb=None, cached=False,
+               profile=None):
+    """
+    appends the metrics of one step to PipelineMetrics.
+    for sql steps the rows in and the peak memory default to the profile values
+    """
+    runId, started = run
+    if profile:
+        rowsIn = rowsIn if rowsIn is not None else profileRowsIn(profile)
+        if peakMemoryMb is None and "system_peak_buffer_memory" in profile:
+            peakMemoryMb = profile["system_peak_buffer_memory"] / 2 ** 20
+    if peakMemoryMb is None:
+        peakMemoryMb = processPeakMemoryMb()
+    connection.execute(
+        "INSERT INTO PipelineMetrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [runId, started, step, seconds, rowsIn, rowsOut, peakMemoryMb, cached,
+         json.dumps(profile) if profile else None]
+    )
+
+
+# -------------- timedStep--------------
+def timedStep(connection, run, step, func, rowsIn=None, rowsOut=None):
+    """
+    runs a python level step (ingestion, export) and records its wall time and the process peak memory
+    :param rowsOut: a function of the step result that returns the rows out
+    :return: what func returned
+    """
+    start = time.perf_counter()
+    value = func()
+    recordStep(connection, run, step, time.perf_counter() - start, rowsIn,
+               rowsOut(value) if rowsOut else None)
+    return value
@@ -0,0 +1,59 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+Renders the figures the dashboard pages start with (their default filters) into the figure cache
+directory of the current snapshot, run it after duckdb_sqlite.py published a new snapshot:
+python duckdb_sqlite.py && python prewarm.py
+Every server process, also one that was just restarted, then reads these figures instead of rendering them.
+The tables themselves need no warming, they are read from the Arrow files the pipeline exported.
+"""
+
+import argparse
+import os
+import shutil
+import time
+import dashboard_data as dd
+import dashboard_plots as dp
+
+
+# -------------- prewarmFigures--------------
+def prewarmFigures(force=False):
+    """
+    renders the figures of dashboard_plots.default_renders that are not in the figure cache yet
+    :param force: remove the figure cache of the snapshot first and render all of them again
+    :return: figure name -> seconds it took to render it, for the figures that were rendered
+    """
+    version = dd.pin_data_version()
+    if force:
+        shutil.rmtree(os.path.join(version, dp.FIGURE_CACHE_DIR), ignore_errors=True)
+    start = time.perf_counter()
+    renders = dp.default_renders()
+    loadSeconds = time.perf_counter() - start
+    print(f"loaded the data of {len(renders)} figures in {loadSeconds:.3f}s")
+    timings = {}
+    for plotName, (key, render) in renders.items():
+        if dp._read_figure(key) is not None:
+            continue
+        start = time.perf_counter()
+        dp.cached_render(key, render, persist=True)
+        timings[plotName] = time.perf_counter() - start
+    return timings
+
+
+# -------------- main--------------
+def main():
+    parser = argparse.ArgumentParser(description="render the default dashboard figures of the current snapshot")
+    parser.add_argument("--force", action="store_true", help="render the figures that are already cached again")
+    args = parser.parse_args()
+
+    timings = prewarmFigures(args.force)
+    for plotName, seconds in timings.items():
+        print(f"rendered {plotName:<30}{seconds:.3f}s")
+    print(f"prewarmed {len(timings)} figures into {dd.data_version()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+A persistent cache of the query result tables.
+A result is stored as a parquet file under a key made of the normalized query text and a
+fingerprint of the staged source data, so when neither the data nor the sql changed the
+query is not executed again. The cache is bounded, the least recently used results are evicted.
+"""
+
+import hashlib
+import os
+import re
+
+# the directory of the cached result files
+CACHE_DIR = "query_cache"
+
+# eviction limits, the least recently used results are removed first
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_MAX_ENTRIES = 200
+
+
+# -------------- createCacheTables--------------
+def createCacheTables(connection):
+    """
+    creates the cache index and the table that remembers which cache key every result table holds
+    :param connection: the DuckDB connection
+    """
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS QueryCacheIndex (
+            Cache_Key VARCHAR PRIMARY KEY,
+            Table_Name VARCHAR,
+            File VARCHAR,
+            Bytes BIGINT,
+            Rows BIGINT,
+            Created_At TIMESTAMP,
+            Last_Used TIMESTAMP
+        )
+    """)
+    connection.execute("CREATE TABLE IF NOT EXISTS ResultTableKeys (Table_Name VARCHAR PRIMARY KEY, Cache_Key VARCHAR)")
+
+
+# -------------- normalizeQuery--------------
+def normalizeQuery(query):
+    """
+    :param query: sql text
+    :return: the query with collapsed whitespace and without the trailing semicolon,
+             so formatting changes do not invalidate the cache
+    """
+    return re.sub(r"\s+", " ", query).strip().rstrip(";").strip()
+
+
+# -------------- sourceFingerprint--------------
+def sourceFingerprint(connection, files):
+    """
+    fingerprints the source data by the size and modification time of every file and,
+    for parquet files, the row count and compressed size of every row group.
+    :param connection: the DuckDB connection
+    :param files: the source files (the staged parquet parts)
+    :return: hex digest of the fingerprint
+    """
+    digest = hashlib.sha256()
+    files = sorted(files)
+    for file in files:
+        stat = os.stat(file)
+        digest.update(f"{file}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    parquetFiles = [file for file in files if file.endswith(".parquet")]
+    if parquetFiles:
+        rowGroups = connection.execute("""
+            SELECT DISTINCT file_name, row_group_id, row_group_num_rows, row_group_bytes
+            FROM parquet_metadata(?)
+            ORDER BY file_name, row_group_id
+        """, [parquetFiles]).fetchall()
+        for rowGroup in rowGroups:
+            digest.update(("|".join(str(value) for value in rowGroup) + "\n").encode())
+    return digest.hexdigest()
+
+
+# -------------- cacheKey--------------
+def cacheKey(query, fingerprint):
+    """
+    :param query: the sql text of the result table
+    :param fingerprint: the source fingerprint
+    :return: the content address of the result
+    """
+    return hashlib.sha256((normalizeQuery(query) + "\n" + fingerprint).encode()).hexdigest()
+
+
+# -------------- cachedSave--------------
+def cachedSave(cursor, tableName, query, fingerprint, execute=None):
+    """
+    creates tableName from the cache when possible.
+    if the table already holds the cached result nothing is done, if the result is cached
+    the table is restored from its parquet file, otherwise the query runs and its result is cached.
+    :param cursor: the DuckDB cursor to run on
+    :param tableName: the result table
+    :param query: the query of the result table
+    :param fingerprint: the source fingerprint of this run
+    :param execute: execute(cursor, sql) runs the query on a cache miss and returns the first result row
+    :return: (number of rows, True if it was a cache hit)
+    """
+    key = cacheKey(query, fingerprint)
+    entry = cursor.execute("SELECT File, Rows FROM QueryCacheIndex WHERE Cache_Key = ?", [key]).fetchone()
+    if entry is not None and os.path.exists(entry[0]):
+        file, rows = entry
+        current = cursor.execute("SELECT Cache_Key FROM ResultTableKeys WHERE Table_Name = ?", [tableName]).fetchone()
+        tableExists = cursor.execute(
+            "SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = ? AND NOT temporary", [tableName]
+        ).fetchone()[0] > 0
+        if current is None or current[0] != key or not tableExists:
+            cursor.execute(f"CREATE OR REPLACE TABLE {tableName} AS SELECT * FROM read_parquet('{file}')")
+            cursor.execute("INSERT OR REPLACE INTO ResultTableKeys VALUES (?, ?)", [tableName, key])
+        cursor.execute("UPDATE QueryCacheIndex SET Last_Used = current_localtimestamp() WHERE Cache_Key = ?", [key])
+        return rows, True
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    file = os.path.join(CACHE_DIR, f"{key}.parquet")
+    execute = execute or (lambda cursor, sql: cursor.execute(sql).fetchone())
+    rows = execute(cursor, f"CREATE OR REPLACE TABLE {tableName} AS {query}")[0]
+    cursor.execute(f"COPY {tableName} TO '{file}' (FORMAT PARQUET, COMPRESSION ZSTD)")
+    cursor.execute("""
+        INSERT OR REPLACE INTO QueryCacheIndex
+        VALUES (?, ?, ?, ?, ?, current_localtimestamp(), current_localtimestamp())
+    """, [key, tableName, file, os.path.getsize(file), rows])
+    cursor.execute("INSERT OR REPLACE INTO ResultTableKeys VALUES (?, ?)", [tableName, key])
+    return rows, False
+
+
+# -------------- evictCache--------------
+def evictCache(connection, maxBytes=CACHE_MAX_BYTES, maxEntries=CACHE_MAX_ENTRIES):
+    """
+    removes the least recently used results until the cache fits in maxBytes and maxEntries
+    :param connection: the DuckDB connection
+    :return: the number of evicted results
+    """
+    entries = connection.execute(
+        "SELECT Cache_Key, File, Bytes FROM QueryCacheIndex ORDER BY Last_Used DESC"
+    ).fetchall()
+    keptBytes = 0
+    evicted = []
+    for position, (key, file, size) in enumerate(entries):
+        if position < maxEntries and keptBytes + size <= maxBytes:
+            keptBytes += size
+        else:
+            evicted.append((key, file))
+    for key, file in evicted:
+        removeEntry(connection, key, file)
+    return len(evicted)
+
+
+# -------------- invalidateCache--------------
+def invalidateCache(connection, tableNames=None):
+    """
+    removes cached results, the next run executes their queries again
+    :param connection: the DuckDB connection
+    :param tableNames: only remove the results of these tables, all the results when None
+    :return: the number of removed results
+    """
+    entries = connection.execute("SELECT Cache_Key, File, Table_Name FROM QueryCacheIndex").fetchall()
+    removed = 0
+    for key, file, tableName in entries:
+        if tableNames is None or tableName in tableNames:
+            removeEntry(connection, key, file)
+            removed += 1
+    return removed
+
+
+# -------------- removeEntry--------------
+def removeEntry(connection, key, file):
+    """
+    deletes a cached result file and its index rows
+    """
+    if os.path.exists(file):
+        os.remove(file)
+    connection.execute("DELETE FROM QueryCacheIndex WHERE Cache_Key = ?", [key])
+    connection.execute("DELETE FROM ResultTableKeys WHERE Cache_Key = ?", [key])
@@ -0,0 +1,92 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+Stratified, reproducible samples of JobsData.
+Every row gets a priority - a hash of the sample seed and its "Job Id" - and a sample keeps, for
+every value of its stratify column, the rows with the smallest priorities. This is reservoir
+sampling with seeded priorities: each stratum holds a uniform sample of its rows, small strata
+are never left out, and the same seed always gives the same sample.
+Because the kept rows are the k smallest priorities, a new ingest batch is merged into the
+sample without looking at the rows that were seen before, the result is the same as a full resample.
+"""
+
+# sample table -> (the stratify column, rows per stratum, seed)
+SAMPLES = {
+    "SampleJobsData": ("Country", 3, 42),
+    "SampleByPortal": ("Job Portal", 30, 42),
+}
+
+
+# -------------- createSampleWatermark--------------
+def createSampleWatermark(connection):
+    """
+    creates the table that remembers the definition of every sample and how many JobsData rows it saw
+    """
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS SampleWatermark (
+            Sample_Table VARCHAR PRIMARY KEY,
+            Definition VARCHAR,
+            Rows_Sampled BIGINT
+        )
+    """)
+
+
+# -------------- sampleQuery--------------
+def sampleQuery(source, column, perStratum, seed):
+    """
+    :param source: the table (or subquery) of the rows to sample
+    :param column: the stratify column
+    :param perStratum: the number of rows kept for every value of column
+    :param seed: the seed of the row priorities
+    :return: the query of the perStratum rows with the smallest priority in every stratum
+    """
+    return f"""
+        SELECT * FROM {source}
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY "{column}" ORDER BY hash({int(seed)}, "Job Id"), "Job Id") <= {int(perStratum)}
+        ORDER BY "{column}", "Job Id"
+    """
+
+
+# -------------- refreshSamples--------------
+def refreshSamples(connection, source="JobsData", batch=None, totalRows=None):
+    """
+    brings the SAMPLES tables up to date.
+    when a sample saw exactly the rows before the batch, only the batch rows compete with the
+    rows already in the sample, otherwise (first run, a changed definition, an unknown row count)
+    it is rebuilt from source.
+    :param connection: the DuckDB connection
+    :param source: the table (or subquery) of all the rows
+    :param batch: the table (or subquery) of the rows added by this run with the columns of source, None when
+                  no rows were added
+    :param totalRows: the number of rows in source, None when it is not known (the samples are then rebuilt)
+    :return: the sample tables that were merged or already up to date (the others were rebuilt)
+    """
+    createSampleWatermark(connection)
+    batchRows = connection.execute(f"SELECT COUNT(*) FROM {batch}").fetchone()[0] if batch else 0
+    merged = []
+    connection.execute("BEGIN TRANSACTION")
+    for sampleTable, (column, perStratum, seed) in SAMPLES.items():
+        definition = repr((column, perStratum, seed))
+        watermark = connection.execute(
+            "SELECT Definition, Rows_Sampled FROM SampleWatermark WHERE Sample_Table = ?", [sampleTable]
+        ).fetchone()
+        merge = (totalRows is not None and watermark is not None and watermark[0] == definition
+                    and watermark[1] is not None and watermark[1] + batchRows == totalRows)
+        if merge:
+            if batchRows > 0:
+                candidates = f"(SELECT * FROM {sampleTable} UNION ALL BY NAME SELECT * FROM {batch})"
+                connection.execute(
+                    f"CREATE OR REPLACE TABLE {sampleTable} AS {sampleQuery(candidates, column, perStratum, seed)}"
+                )
+            merged.append(sampleTable)
+        else:
+            connection.execute(
+                f"CREATE OR REPLACE TABLE {sampleTable} AS {sampleQuery(source, column, perStratum, seed)}"
+            )
+        connection.execute("INSERT OR REPLACE INTO SampleWatermark VALUES (?, ?, ?)",
+                           [sampleTable, definition, totalRows])
+    connection.execute("COMMIT")
+    return merged
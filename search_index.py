@@ -0,0 +1,209 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+A full text index of the job postings, ranked with BM25.
+The index is an inverted index kept in parquet parts: SearchPostings holds the term frequency of every
+(term, posting) pair, with the length of the posting. The postings of a batch are written as a new part in
+SEARCH_DIR sorted by term, so a search reads only the row groups of its terms. Like the staged parts, a part
+is recorded in SearchParts in the transaction of its batch and is never changed, so a snapshot can hard link it.
+Job postings are never changed after they are loaded, so every ingest batch is appended to the index. The
+document frequencies are counted when searching and the number of postings and their total length are kept
+in SearchWatermark, so the result is the same as an index built from scratch.
+"""
+
+import glob
+import os
+import re
+
+# the parquet parts of the index
+SEARCH_DIR = "search_postings"
+
+# the text columns of a posting, indexed together as one bag of words
+SEARCH_COLUMNS = ("Job Title", "Role", "Job Description", "skills", "Benefits", "Responsibilities", "Company")
+
+# the lower cased text is split into terms on everything but letters and digits, + and # are kept for c++ and c#
+SEPARATOR_PATTERN = "[^a-z0-9+#]+"
+
+STOPWORDS = ("a", "an", "and", "are", "as", "at", "be", "by", "e", "for", "from", "g", "in", "is", "it", "of",
+             "on", "or", "s", "that", "the", "their", "this", "to", "with")
+
+# the BM25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+
+# -------------- createSearchTables--------------
+def createSearchTables(connection):
+    """
+    creates the table of the index parts and the watermark that remembers the definition of the index, how many
+    JobsData rows it saw and their total length
+    """
+    if connection.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = 'SearchPostings' AND NOT temporary"
+    ).fetchone()[0] > 0:
+        # an index kept in a DuckDB table by an earlier version, it is built again as parquet parts
+        connection.execute("DROP TABLE SearchPostings")
+        connection.execute("DROP TABLE IF EXISTS SearchWatermark")
+    connection.execute("CREATE TABLE IF NOT EXISTS SearchParts (Part INTEGER, File VARCHAR)")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS SearchWatermark (
+            Definition VARCHAR,
+            Rows_Indexed BIGINT,
+            Total_Length BIGINT
+        )
+    """)
+
+
+# -------------- searchTerms--------------
+def searchTerms(text):
+    """
+    :param text: a search text
+    :return: the distinct terms of the text, tokenized like the indexed columns
+    """
+    return list(dict.fromkeys(term for term in re.split(SEPARATOR_PATTERN, text.lower())
+                              if term and term not in STOPWORDS))
+
+
+# -------------- searchFiles--------------
+def searchFiles(connection):
+    """
+    :return: the parquet files of the committed index parts
+    """
+    return [file for (file,) in connection.execute("SELECT File FROM SearchParts ORDER BY Part").fetchall()]
+
+
+# -------------- indexBatch--------------
+def indexBatch(connection, source):
+    """
+    writes the postings of the rows of source as a new index part, in the caller transaction
+    :param connection: the DuckDB connection
+    :param source: the table (or subquery) of the rows to index
+    :return: the total length of the indexed rows
+    """
+    text = "concat_ws(' ', " + ", ".join(f'"{column}"' for column in SEARCH_COLUMNS) + ")"
+    stopwords = ", ".join(f"'{word}'" for word in STOPWORDS)
+    connection.execute(f"""
+        CREATE OR REPLACE TEMP TABLE SearchBatch AS
+        SELECT Term, Doc_Id, CAST(COUNT(*) AS INTEGER) AS Tf
+        FROM (
+            SELECT "Job Id" AS Doc_Id, unnest(string_split_regex(lower({text}), '{SEPARATOR_PATTERN}')) AS Term
+            FROM {source}
+        )
+        WHERE Term <> '' AND Term NOT IN ({stopwords})
+        GROUP BY Term, Doc_Id
+    """)
+    os.makedirs(SEARCH_DIR, exist_ok=True)
+    partNumber = connection.execute("SELECT COALESCE(MAX(Part), 0) + 1 FROM SearchParts").fetchone()[0]
+    partFile = os.path.join(SEARCH_DIR, f"postings-{partNumber:05d}.parquet")
+    connection.execute(f"""
+        COPY (
+            SELECT *, CAST(SUM(Tf) OVER (PARTITION BY Doc_Id) AS INTEGER) AS Length
+            FROM SearchBatch
+            ORDER BY Term, Doc_Id
+        ) TO '{partFile}' (FORMAT PARQUET, COMPRESSION ZSTD)
+    """)
+    connection.execute("INSERT INTO SearchParts VALUES (?, ?)", [partNumber, partFile])
+    totalLength = connection.execute("SELECT COALESCE(SUM(Tf), 0) FROM SearchBatch").fetchone()[0]
+    connection.execute("DROP TABLE SearchBatch")
+    return totalLength
+
+
+# -------------- refreshSearchIndex--------------
+def refreshSearchIndex(connection, source="JobsData", batch=None, totalRows=None):
+    """
+    brings the index up to date.
+    when the index saw exactly the rows before the batch only the batch is indexed, otherwise (first run,
+    a changed definition, an unknown row count) the index is rebuilt from source.
+    :param connection: the DuckDB connection
+    :param source: the table (or subquery) of all the rows
+    :param batch: the table (or subquery) of the rows added by this run, None when no rows were added
+    :param totalRows: the number of rows in source, None when it is not known (the index is then rebuilt)
+    :return: True when the batch was appended (or nothing changed), False when the index was rebuilt
+    """
+    createSearchTables(connection)
+    removeUnusedParts(connection)
+    definition = repr((SEARCH_COLUMNS, SEPARATOR_PATTERN, STOPWORDS))
+    batchRows = connection.execute(f"SELECT COUNT(*) FROM {batch}").fetchone()[0] if batch else 0
+    watermark = connection.execute("SELECT Definition, Rows_Indexed, Total_Length FROM SearchWatermark").fetchone()
+    append = (totalRows is not None and watermark is not None and watermark[0] == definition
+              and watermark[1] + batchRows == totalRows)
+    connection.execute("BEGIN TRANSACTION")
+    if append:
+        totalLength = watermark[2] + (indexBatch(connection, batch) if batchRows > 0 else 0)
+    else:
+        connection.execute("DELETE FROM SearchParts")
+        totalLength = indexBatch(connection, source)
+        # postings without any term never match, but they count in the statistics
+        totalRows = connection.execute(f"SELECT COUNT(*) FROM {source}").fetchone()[0]
+    connection.execute("DELETE FROM SearchWatermark")
+    connection.execute("INSERT INTO SearchWatermark VALUES (?, ?, ?)", [definition, totalRows, totalLength])
+    connection.execute("COMMIT")
+    removeUnusedParts(connection)
+    connection.execute(f"CREATE OR REPLACE VIEW SearchPostings AS SELECT * FROM {searchReader(searchFiles(connection))}")
+    return append
+
+
+# -------------- removeUnusedParts--------------
+def removeUnusedParts(connection):
+    """
+    removes the part files that are not committed: written by a run that stopped, or replaced by a rebuild
+    """
+    committedFiles = set(searchFiles(connection))
+    for file in glob.glob(os.path.join(SEARCH_DIR, "postings-*.parquet")):
+        if file not in committedFiles:
+            os.remove(file)
+
+
+# -------------- searchReader--------------
+def searchReader(files):
+    """
+    :param files: the parquet files of the index parts
+    :return: the read_parquet table function of the parts
+    """
+    quoted = ["'" + file.replace("'", "''") + "'" for file in files]
+    return f"read_parquet([{', '.join(quoted)}])"
+
+
+# -------------- searchQuery--------------
+def searchQuery(terms, columns, limit, offset=0):
+    """
+    :param terms: the search terms (searchTerms)
+    :param columns: the JobsData columns of every result
+    :param limit: the number of results
+    :param offset: the number of better ranked results that are skipped
+    :return: the query and its parameters. it returns the columns, the BM25 Score and the Matches count
+             of the results ranked by score (ties by "Job Id")
+    """
+    selected = ", ".join(f'"{column}"' for column in columns)
+    query = f"""
+        WITH Stats AS (
+            SELECT Rows_Indexed AS Docs, CAST(Total_Length AS DOUBLE) / GREATEST(Rows_Indexed, 1) AS Avg_Length
+            FROM SearchWatermark
+        ),
+        Frequencies AS (
+            SELECT Term, ln(1 + (Docs - COUNT(*) + 0.5) / (COUNT(*) + 0.5)) AS Idf
+            FROM SearchPostings
+            CROSS JOIN Stats
+            WHERE Term IN ({", ".join("?" * len(terms))})
+            GROUP BY Term, Docs
+        ),
+        Scores AS (
+            SELECT Doc_Id,
+                   SUM(Idf * Tf * ({K1} + 1) / (Tf + {K1} * (1 - {B} + {B} * Length / Avg_Length))) AS Score,
+                   COUNT(*) OVER () AS Matches
+            FROM SearchPostings
+            JOIN Frequencies USING (Term)
+            CROSS JOIN Stats
+            GROUP BY Doc_Id
+            ORDER BY Score DESC, Doc_Id
+            LIMIT {int(limit)} OFFSET {int(offset)}
+        )
+        SELECT {selected}, Score, Matches
+        FROM Scores
+        JOIN JobsData ON "Job Id" = Doc_Id
+        ORDER BY Score DESC, Doc_Id
+    """
+    return query, list(terms)
@@ -0,0 +1,107 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+Versioned, immutable snapshots of the databases the dashboard reads.
+Every pipeline run publishes a new snapshot directory (snapshots/000042) with the SQLite file, the Arrow
+tables, the staged parquet parts and the parts of the search index, and then points the CURRENT file at it
+with a rename. The dashboard reads CURRENT on every request, so it switches to the new snapshot at the next
+request, it never sees half of a run and it never waits for the lock the pipeline holds on its working database.
+All these files are only ever written once and replaced with a rename or a new part, so they are hard linked
+into the snapshot and a snapshot costs no copy. The working DuckDB database is changed in place and is not
+published, the small database the Explore page queries is written into the snapshot by the pipeline.
+"""
+
+import os
+import shutil
+
+SNAPSHOT_DIR = "snapshots"
+CURRENT_FILE = os.path.join(SNAPSHOT_DIR, "CURRENT")
+
+# the older snapshots stay a while for the requests that still read them
+SNAPSHOTS_KEPT = 3
+
+
+# -------------- currentSnapshot--------------
+def currentSnapshot():
+    """
+    :return: the directory of the current snapshot, None when no snapshot was published yet
+    """
+    try:
+        with open(CURRENT_FILE) as file:
+            version = file.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(SNAPSHOT_DIR, version)
+
+
+# -------------- snapshotVersions--------------
+def snapshotVersions():
+    """
+    :return: the published snapshot versions, oldest first
+    """
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    return sorted(int(name) for name in os.listdir(SNAPSHOT_DIR)
+                  if name.isdigit() and os.path.isdir(os.path.join(SNAPSHOT_DIR, name)))
+
+
+# -------------- linkOrCopy--------------
+def linkOrCopy(source, target):
+    """
+    hard links a file, or copies it when the file system has no hard links
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+# -------------- linkTree--------------
+def linkTree(source, target):
+    """
+    hard links the files of a directory and of all its subdirectories, the temp files are skipped
+    """
+    for directory, _, names in os.walk(source):
+        targetDir = os.path.join(target, os.path.relpath(directory, source))
+        os.makedirs(targetDir, exist_ok=True)
+        for name in names:
+            if not name.endswith(".tmp"):
+                linkOrCopy(os.path.join(directory, name), os.path.join(targetDir, name))
+
+
+# -------------- publishSnapshot--------------
+def publishSnapshot(linked, build=None):
+    """
+    publishes a new snapshot and removes the snapshots older than the SNAPSHOTS_KEPT newest.
+    the snapshot is built in a temp directory and renamed, and only then CURRENT is replaced.
+    :param linked: the files and directories (of files) that are only ever replaced with a rename or added
+    :param build: called with the directory of the new snapshot once its files are in place and before it
+                  becomes current, to write the files that refer to the snapshot paths
+    :return: the version of the new snapshot
+    """
+    versions = snapshotVersions()
+    version = f"{versions[-1] + 1 if versions else 1:06d}"
+    tempDir = os.path.join(SNAPSHOT_DIR, version + ".tmp")
+    shutil.rmtree(tempDir, ignore_errors=True)
+    os.makedirs(tempDir)
+    for path in linked:
+        if os.path.isdir(path):
+            linkTree(path, os.path.join(tempDir, os.path.basename(path)))
+        elif os.path.exists(path):
+            linkOrCopy(path, os.path.join(tempDir, os.path.basename(path)))
+    versionDir = os.path.join(SNAPSHOT_DIR, version)
+    os.rename(tempDir, versionDir)
+    if build is not None:
+        build(versionDir)
+
+    with open(CURRENT_FILE + ".tmp", "w") as file:
+        file.write(version)
+    os.replace(CURRENT_FILE + ".tmp", CURRENT_FILE)
+
+    for oldVersion in snapshotVersions()[:-SNAPSHOTS_KEPT]:
+        # a snapshot that is still open (windows) is removed by a later run
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, f"{oldVersion:06d}"), ignore_errors=True)
+    return version
@@ -0,0 +1,220 @@
+# ---------------- Big Data: Last Exercise-----------------------
+# Submitting:
+# Re'em Hoisman
+# Alon Zargari
+
+"""
+Here we generate synthetic job postings with the same schema as job_descriptions.csv,
+so the pipeline can be measured at any scale.
+The generator is deterministic: every value is picked by a hash of the row number, the seed
+and the column, so the same seed and row range always produce the same file.
+The rows are generated and written by DuckDB, so 50M rows are streamed without holding them in memory.
+"""
+
+import argparse
+import duckdb
+import os
+
+# the row counts we benchmark at
+SCALES = {"100k": 100_000, "1.6M": 1_600_000, "10M": 10_000_000, "50M": 50_000_000}
+
+COUNTRIES = ['Israel', 'USA', 'Japan', 'Germany', 'UK', 'France', 'Italy', 'Canada', 'China', 'India', 'Brazil',
+             'Mexico', 'Spain', 'Netherlands', 'Sweden', 'Norway', 'Denmark', 'Finland', 'Poland', 'Austria',
+             'Switzerland', 'Belgium', 'Portugal', 'Greece', 'Turkey', 'Egypt', 'Nigeria', 'Kenya', 'South Africa',
+             'Morocco', 'Argentina', 'Chile', 'Colombia', 'Peru', 'Australia', 'New Zealand', 'Indonesia',
+             'Malaysia', 'Singapore', 'Thailand', 'Vietnam', 'Philippines', 'South Korea', 'Pakistan', 'Bangladesh',
+             'Saudi Arabia', 'United Arab Emirates', 'Ireland', 'Czech Republic', 'Hungary', 'Romania', 'Malta',
+             'Iceland', 'Fiji', 'Isle of Man']
+
+CITIES = ['Douglas', 'Ashgabat', 'Macao', 'Porto-Novo', 'Santiago', 'Tel Aviv', 'Paris', 'Berlin', 'Tokyo',
+          'London', 'Rome', 'Toronto', 'New York', 'Madrid', 'Oslo', 'Lisbon', 'Cairo', 'Lima', 'Sydney', 'Seoul']
+
+QUALIFICATIONS = ['B.Tech', 'M.Tech', 'BBA', 'MBA', 'PhD', 'BCA', 'MCA', 'M.Com', 'B.Com', 'BA']
+
+PREFERENCES = ['Male', 'Female', 'Both']
+
+WORK_TYPES = ['Intern', 'Part-Time', 'Temporary', 'Contract', 'Full-Time']
+
+JOB_PORTALS = ['Snagajob', 'Idealist', 'Jobs2Careers', 'FlexJobs', 'Stack Overflow Jobs', 'Internships.com',
+               'Monster', 'Indeed', 'LinkedIn', 'Glassdoor', 'ZipRecruiter', 'Dice', 'SimplyHired', 'CareerBuilder',
+               'USAJOBS', 'The Muse']
+
+FIRST_NAMES = ['Brandon', 'Francisco', 'Gary', 'Joy', 'Amanda', 'Michael', 'Sarah', 'David', 'Laura', 'James',
+               'Maria', 'Robert', 'Linda', 'John', 'Emily', 'Daniel', 'Jessica', 'Kevin', 'Ashley', 'Brian']
+
+LAST_NAMES = ['Cunningham', 'Charles', 'Jackson', 'Lopez', 'Smith', 'Johnson', 'Williams', 'Brown', 'Jones',
+              'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez', 'Hernandez', 'Wilson', 'Anderson', 'Thomas',
+              'Taylor', 'Moore']
+
+COMPANY_NAMES = ['Icahn Enterprises', 'PNC Financial Services Group', 'United Services Automobile Assn.', 'Hess',
+                 'Cairn Energy', 'Cognizant Technology Solutions', 'Bunge', 'Dominion Energy', 'Wells Fargo',
+                 'Estee Lauder', 'Lincoln National', 'Hormel Foods', 'Altria Group', 'Jabil', 'Ryder System',
+                 'Western Digital', 'Fifth Third Bancorp', 'AGCO', 'Arconic', 'Nucor', 'Southern Company',
+                 'Whirlpool', 'Xerox', 'Yum China', 'Zimmer Biomet', 'Kellogg', 'Las Vegas Sands', 'Mastercard',
+                 'Nordstrom', 'Oshkosh']
+
+COMPANY_SUFFIXES = ['', ' Holdings', ' Group', ' International', ' Services', ' Solutions']
+
+SECTORS = ['Financial Services', 'Energy', 'Technology', 'Healthcare', 'Retail', 'Industrials', 'Food Processing',
+           'Insurance', 'Transportation', 'Materials']
+
+# (Job Title, Role, skills, Responsibilities) - the text columns of a posting belong together
+ROLES = [
+    ('Digital Marketing Specialist', 'Social Media Manager',
+     'Social media platforms (e.g., Facebook, Twitter, Instagram) Content creation and scheduling Social media analytics',
+     'Manage and grow social media accounts, create engaging content, and interact with the online community.'),
+    ('Web Developer', 'Frontend Web Developer',
+     'HTML, CSS, JavaScript Frontend frameworks (e.g., React, Angular) User experience (UX)',
+     'Design and code user interfaces for websites, ensuring a seamless and visually appealing user experience.'),
+    ('Operations Manager', 'Quality Control Manager',
+     'Quality control processes and methodologies Statistical process control (SPC) Root cause analysis',
+     'Establish and enforce quality control standards and processes, conduct inspections and audits.'),
+    ('Network Engineer', 'Wireless Network Engineer',
+     'Wireless network design and architecture Wi-Fi standards and protocols RF propagation modeling',
+     'Design, configure, and optimize wireless networks, ensuring coverage and security.'),
+    ('Event Manager', 'Conference Manager',
+     'Event planning Conference logistics Budget management Vendor coordination Marketing and promotion',
+     'Specialize in conference and convention planning, coordinating logistics and attendee registration.'),
+    ('Software Tester', 'Quality Assurance Analyst',
+     'Test automation Selenium Python Regression testing Bug tracking (e.g., Jira)',
+     'Plan and execute test cases, automate regression suites and report defects to the development team.'),
+    ('Data Scientist', 'Machine Learning Engineer',
+     'Python SQL Machine learning Statistics Deep learning frameworks (e.g., TensorFlow, PyTorch)',
+     'Build, train and deploy machine learning models and analyze large data sets to support decisions.'),
+    ('Nurse Practitioner', 'Pediatric Nurse Practitioner',
+     'Pediatric care Patient assessment Medication administration Family education',
+     'Provide primary care to children, diagnose and treat illnesses and educate families on health.'),
+    ('Financial Analyst', 'Investment Analyst',
+     'Financial modeling Valuation Excel Market research Portfolio analysis',
+     'Analyze investment opportunities, build financial models and prepare recommendations for clients.'),
+    ('UX/UI Designer', 'User Interface Designer',
+     'User interface design Wireframing Prototyping tools (e.g., Figma, Sketch) Visual design',
+     'Create intuitive interfaces and visual designs, prototype ideas and test them with users.'),
+]
+
+BENEFITS = ["{'Flexible Spending Accounts (FSAs), Relocation Assistance, Legal Assistance, Employee Recognition Programs, Financial Counseling'}",
+            "{'Health Insurance, Retirement Plans, Paid Time Off (PTO), Flexible Work Arrangements, Employee Assistance Programs (EAP)'}",
+            "{'Tuition Reimbursement, Stock Options or Equity Grants, Parental Leave, Wellness Programs, Childcare Assistance'}",
+            "{'Casual Dress Code, Social and Recreational Activities, Employee Referral Programs, Health and Wellness Facilities, Life and Disability Insurance'}",
+            "{'Transportation Benefits, Bonuses and Incentive Programs, Flexible Spending Accounts (FSAs), Paid Time Off (PTO), Health Insurance'}"]
+
+
+# -------------- sqlList--------------
+def sqlList(values):
+    """
+    :param values: list of strings
+    :return: the strings as a duckdb list literal
+    """
+    return "[" + ", ".join("'" + value.replace("'", "''") + "'" for value in values) + "]"
+
+
+# -------------- jobsQuery--------------
+def jobsQuery(firstRow, rows):
+    """
+    :param firstRow: the row number of the first generated row, rows with different numbers get different Job Ids
+    :param rows: the number of rows
+    :return: the query that generates the rows, it uses the pick and skewed macros of createMacros()
+    """
+    companies = [name + suffix for name in COMPANY_NAMES for suffix in COMPANY_SUFFIXES]
+    people = [first + ' ' + last for first in FIRST_NAMES for last in LAST_NAMES]
+    return f"""
+        SELECT
+            1000000000000000 + i * 7919 AS "Job Id",
+            min_exp || ' to ' || (5 + roll(i, 'max_exp') % 11) || ' Years' AS Experience,
+            pick({sqlList(QUALIFICATIONS)}, i, 'qualification') AS Qualifications,
+            '$' || (55 + roll(i, 'min_salary') % 11) || 'K-$' || (80 + roll(i, 'max_salary') % 51) || 'K' AS "Salary Range",
+            pick({sqlList(CITIES)}, i, 'city') AS location,
+            pick({sqlList(COUNTRIES)}, i, 'country') AS Country,
+            ROUND((roll(i, 'latitude') % 180000) / 1000.0 - 90, 4) AS latitude,
+            ROUND((roll(i, 'longitude') % 360000) / 1000.0 - 180, 4) AS longitude,
+            pick({sqlList(WORK_TYPES)}, i, 'work_type') AS "Work Type",
+            12646 + roll(i, 'company_size') % 100000 AS "Company Size",
+            DATE '2021-09-15' + CAST(roll(i, 'date') % 731 AS INTEGER) AS "Job Posting Date",
+            pick({sqlList(PREFERENCES)}, i, 'preference') AS Preference,
+            skewed({sqlList(people)}, i, 'contact') AS "Contact Person",
+            '(' || (200 + roll(i, 'area') % 800) || ')' || (1000000 + roll(i, 'phone') % 9000000) AS Contact,
+            role[1] AS "Job Title",
+            role[2] AS Role,
+            pick({sqlList(JOB_PORTALS)}, i, 'portal') AS "Job Portal",
+            'A ' || role[2] || ' is responsible for the ' || lower(role[1]) || ' work of the team. ' || role[4]
+                || ' The position requires ' || lower(role[3]) || '.' AS "Job Description",
+            pick({sqlList(BENEFITS)}, i, 'benefits') AS Benefits,
+            role[3] AS skills,
+            role[4] AS Responsibilities,
+            company AS Company,
+            '{{"Sector":"' || pick({sqlList(SECTORS)}, hash(company), 'sector') || '","City":"'
+                || pick({sqlList(CITIES)}, hash(company), 'hq') || '"}}' AS "Company Profile"
+        FROM (
+            SELECT i,
+                   roll(i, 'min_exp') % 6 AS min_exp,
+                   pick([{', '.join(sqlList(role) for role in ROLES)}], i, 'role') AS role,
+                   skewed({sqlList(companies)}, i, 'company') AS company
+            FROM range({firstRow}, {firstRow + rows}) t(i)
+        )
+    """
+
+
+# -------------- createMacros--------------
+def createMacros(connection, seed):
+    """
+    roll(i, salt) - a deterministic pseudo random number of row i for a column
+    pick(choices, i, salt) - a uniform choice
+    skewed(choices, i, salt) - a choice where the first choices are much more common (recruiters and companies)
+    """
+    connection.execute(f"CREATE OR REPLACE MACRO roll(i, salt) AS hash(i, {int(seed)}, salt)")
+    # the modulo is kept unsigned, hash() % BIGINT would be computed as a (much slower) HUGEINT
+    connection.execute("""
+        CREATE OR REPLACE MACRO pick(choices, i, salt) AS
+        list_extract(choices, 1 + CAST(roll(i, salt) % CAST(len(choices) AS UBIGINT) AS INTEGER))
+    """)
+    connection.execute("""
+        CREATE OR REPLACE MACRO skewed(choices, i, salt) AS
+        list_extract(choices, 1 + CAST(floor(len(choices) * pow((roll(i, salt) % 1000000) / 1000000.0, 3)) AS INTEGER))
+    """)
+
+
+# -------------- generateJobsCsv--------------
+def generateJobsCsv(output, rows, seed=42, firstRow=0, shards=1):
+    """
+    writes rows synthetic job postings as csv
+    :param output: the csv file, with shards > 1 the files are output with a -00000 .. suffix
+    :param rows: the number of rows
+    :param seed: the same seed always generates the same values
+    :param firstRow: the number of the first row, use the end of the previous file to generate a new daily batch
+    :param shards: the number of csv files to split the rows into
+    :return: the list of written files
+    """
+    connection = duckdb.connect()
+    createMacros(connection, seed)
+    files = []
+    base, extension = os.path.splitext(output)
+    rowsPerShard = -(-rows // shards)
+    for shard in range(shards):
+        shardFirstRow = firstRow + shard * rowsPerShard
+        shardRows = min(rowsPerShard, firstRow + rows - shardFirstRow)
+        if shardRows <= 0:
+            break
+        file = output if shards == 1 else f"{base}-{shard:05d}{extension}"
+        connection.execute(f"COPY ({jobsQuery(shardFirstRow, shardRows)}) TO '{file}' (FORMAT CSV, HEADER)")
+        files.append(file)
+    connection.close()
+    return files
+
+
+# -------------- main--------------
+def main():
+    parser = argparse.ArgumentParser(description="generate synthetic job postings with the job_descriptions.csv schema")
+    parser.add_argument("--scale", choices=list(SCALES), help="a named number of rows")
+    parser.add_argument("--rows", type=int, help="the number of rows (instead of --scale)")
+    parser.add_argument("--output", default="job_descriptions.csv")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--first-row", type=int, default=0, help="row number of the first row (for new batches)")
+    parser.add_argument("--shards", type=int, default=1, help="split the rows into this many csv files")
+    args = parser.parse_args()
+    rows = args.rows if args.rows is not None else SCALES[args.scale or "100k"]
+    for file in generateJobsCsv(args.output, rows, args.seed, args.first_row, args.shards):
+        print(file)
+
+
+if __name__ == "__main__":
+    main()